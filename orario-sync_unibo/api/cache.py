@@ -0,0 +1,468 @@
+import contextlib
+import datetime
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_PATH = os.getenv("BACKEND_CACHE_PATH", "")
+CACHE_MAX_BYTES = int(os.getenv("BACKEND_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("BACKEND_CACHE_MAX_ENTRIES", "2048"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("BACKEND_CACHE_MAX_MEMORY_BYTES", str(128 * 1024 * 1024)))
+SWEEP_INTERVAL_SECONDS = int(os.getenv("BACKEND_CACHE_SWEEP_SECONDS", "60"))
+SQLITE_SCHEMA_VERSION = 5
+
+_ATOMIC_TYPES = (str, bytes, int, float, bool, type(None), datetime.date, datetime.time, datetime.timedelta)
+# Counters also kept per key family, as reported under "families" by the stats() of the cache backends.
+FAMILY_COUNTERS = ("hits", "stale_hits", "misses", "evictions")
+
+logger = logging.getLogger(__name__)
+
+
+def key_family(key):
+    """Gets the family of a cache key: the first item of a tuple key, such as "timetable", or the key itself"""
+    return key[0] if isinstance(key, tuple) and key else key
+
+
+def approximate_size(value):
+    """Approximates the memory held by a cached value, counting shared objects once"""
+    seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, _ATOMIC_TYPES):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            slots = getattr(type(obj), "__slots__", ())
+            stack.extend(getattr(obj, slot) for slot in slots if hasattr(obj, slot))
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+    return total
+
+
+class MemoryCache:
+    """Process-local cache backend mapping keys to values with a soft (fresh) and a hard (stale) expiry time
+
+    The cache is bounded both by number of entries and by the approximate memory held by the values;
+    least recently used entries are evicted first. Entries past their hard expiry are dropped when read or
+    by sweep()."""
+
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, max_bytes=MEMORY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._family_counters = {}
+
+    def _count(self, counter, key):
+        # Called with self._lock held.
+        self._counters[counter] += 1
+        family = self._family_counters.setdefault(key_family(key), dict.fromkeys(FAMILY_COUNTERS, 0))
+        family[counter] += 1
+
+    def _remove(self, key):
+        _, _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def lookup(self, key):
+        """Gets a (value, is_stale) tuple, or None if the entry is missing or past its hard expiry"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count("misses", key)
+                return None
+            fresh_until, expires_at, value, _ = entry
+            if now >= expires_at:
+                self._remove(key)
+                self._counters["expirations"] += 1
+                self._count("misses", key)
+                return None
+            self._entries.move_to_end(key)
+            stale = now >= fresh_until
+            self._count("stale_hits" if stale else "hits", key)
+            return value, stale
+
+    def peek(self, key):
+        """Gets a (value, is_stale) tuple like lookup(), without counting it or refreshing the entry's recency"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or now >= entry[1]:
+            return None
+        return entry[2], now >= entry[0]
+
+    def get(self, key):
+        """Gets a cached value, or None if it is missing or no longer fresh"""
+        entry = self.lookup(key)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def put(self, key, value, ttl, stale_ttl=0):
+        """Caches a value that is fresh for ttl seconds and may be served stale for stale_ttl more seconds
+
+        Least recently used entries are evicted above the configured limits."""
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (now + ttl, now + ttl + stale_ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                evicted = next(iter(self._entries))
+                self._remove(evicted)
+                self._count("evictions", evicted)
+
+    def sweep(self):
+        """Drops every expired entry"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at, _, _) in self._entries.items() if now >= expires_at]
+            for key in expired:
+                self._remove(key)
+            self._counters["expirations"] += len(expired)
+        return len(expired)
+
+    def stats(self):
+        """Gets hit/miss/eviction counters, also per key family, number of entries and approximate bytes held"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters["families"] = {family: dict(values) for family, values in self._family_counters.items()}
+            counters["entries"] = len(self._entries)
+            counters["bytes"] = self._bytes
+        return counters
+
+
+class SqliteCache:
+    """Persistent cache backend storing pickled values in a SQLite file, with the same expiry semantics as MemoryCache
+
+    Entries survive process restarts and are evicted in least recently used order once the total size of the
+    stored values exceeds max_bytes. That total is summed once when the file is opened and then kept up to date
+    by every write, so puts under the budget never scan the table. Each thread uses its own connection; the
+    database runs in WAL mode so readers do not block each other and writes are serialized by a process-wide
+    lock."""
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._family_counters = {}
+        self._bytes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._writing() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SQLITE_SCHEMA_VERSION:
+                # It is only a cache: files written with another layout or value format are dropped, not migrated.
+                conn.execute("DROP TABLE IF EXISTS entries")
+                conn.execute("PRAGMA user_version = {}".format(SQLITE_SCHEMA_VERSION))
+            # The value goes last: reading the other columns of a row then never walks the BLOB's overflow pages.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, family TEXT NOT NULL, size INTEGER NOT NULL, fresh_until REAL NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+            self._bytes = self._stored_bytes(conn)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Runs the statements of the block as one transaction under the write lock
+
+        The transaction is rolled back if the block raises, so a failed write never leaves this thread's
+        connection holding the database lock."""
+        with self._write_lock:
+            conn = self._connection()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                # Whatever the block added to or took from the byte total was rolled back with it.
+                self._bytes = self._stored_bytes(conn)
+                raise
+
+    @staticmethod
+    def _stored_bytes(conn):
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def _encode_key(key):
+        # Cache keys are strings or tuples of strings/ints, whose repr is stable across restarts.
+        return repr(key)
+
+    def lookup(self, key):
+        """Gets a (value, is_stale) tuple, or None if the entry is missing or past its hard expiry"""
+        entry = self.lookup_entry(key)
+        if entry is None:
+            return None
+        value, fresh_until, _ = entry
+        return value, time.time() >= fresh_until
+
+    def peek(self, key):
+        """Gets a (value, is_stale) tuple like lookup(), without counting it or updating the entry's last access"""
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT value, fresh_until FROM entries WHERE key = ? AND expires_at > ?", (self._encode_key(key), now)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0]), now >= row[1]
+        except Exception:  # noqa: BLE001 - entries written by an incompatible release are simply missing
+            return None
+
+    def lookup_entry(self, key):
+        """Gets a (value, fresh_until, expires_at) tuple, or None if the entry is missing or past its hard expiry"""
+        now = time.time()
+        encoded_key = self._encode_key(key)
+        row = self._connection().execute(
+            "SELECT value, fresh_until, expires_at FROM entries WHERE key = ?", (encoded_key,)
+        ).fetchone()
+        family = key_family(key)
+        if row is None:
+            self._count("misses", family)
+            return None
+        value, fresh_until, expires_at = row
+        with self._writing() as conn:
+            if now >= expires_at:
+                self._delete(conn, "key = ? AND expires_at <= ?", (encoded_key, now))
+                self._counters["expirations"] += 1
+                self._count_locked("misses", family)
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, encoded_key))
+        try:
+            value = pickle.loads(value)
+        except Exception:  # noqa: BLE001 - entries written by an incompatible release are simply misses
+            self._count("misses", family)
+            return None
+        self._count("stale_hits" if now >= fresh_until else "hits", family)
+        return value, fresh_until, expires_at
+
+    def get(self, key):
+        """Gets a cached value, or None if it is missing or no longer fresh"""
+        entry = self.lookup(key)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def _count_locked(self, counter, family):
+        self._counters[counter] += 1
+        counters = self._family_counters.setdefault(family, dict.fromkeys(FAMILY_COUNTERS, 0))
+        counters[counter] += 1
+
+    def _count(self, counter, family):
+        with self._write_lock:
+            self._count_locked(counter, family)
+
+    def put(self, key, value, ttl, stale_ttl=0):
+        """Caches a value that is fresh for ttl seconds and may be served stale for stale_ttl more seconds
+
+        Least recently used entries are evicted above max_bytes."""
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        encoded_key = self._encode_key(key)
+        with self._writing() as conn:
+            self._delete(conn, "key = ?", (encoded_key,))
+            conn.execute(
+                "INSERT INTO entries (key, family, size, fresh_until, expires_at, last_access, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (encoded_key, str(key_family(key)), len(blob), now + ttl, now + ttl + stale_ttl, now,
+                 sqlite3.Binary(blob)),
+            )
+            self._bytes += len(blob)
+            self._evict(conn, now)
+
+    def _delete(self, conn, where, params):
+        # Called inside _writing(): drops the matching rows and takes their size off the byte total.
+        freed, deleted = conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries WHERE " + where, params
+        ).fetchone()
+        if deleted:
+            conn.execute("DELETE FROM entries WHERE " + where, params)
+            self._bytes -= freed
+        return deleted
+
+    def _evict(self, conn, now):
+        if self._bytes <= self.max_bytes:
+            return
+        self._counters["expirations"] += self._delete(conn, "expires_at <= ?", (now,))
+        while self._bytes > self.max_bytes:
+            rows = conn.execute("SELECT key, family, size FROM entries ORDER BY last_access LIMIT 64").fetchall()
+            if not rows:
+                break
+            for encoded_key, family, size in rows:
+                conn.execute("DELETE FROM entries WHERE key = ?", (encoded_key,))
+                self._count_locked("evictions", family)
+                self._bytes -= size
+                if self._bytes <= self.max_bytes:
+                    break
+
+    def sweep(self):
+        """Drops every expired entry"""
+        with self._writing() as conn:
+            expired = self._delete(conn, "expires_at <= ?", (time.time(),))
+            self._counters["expirations"] += expired
+        return expired
+
+    def stats(self):
+        """Gets hit/miss/eviction counters, also per key family, number of entries and bytes stored"""
+        entries = self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        with self._write_lock:
+            counters = dict(self._counters)
+            counters["families"] = {family: dict(values) for family, values in self._family_counters.items()}
+            counters["bytes"] = self._bytes
+        counters["entries"] = entries
+        return counters
+
+
+class TieredCache:
+    """Bounded MemoryCache in front of a SqliteCache, written through to both
+
+    Hits on the memory tier never touch SQLite, so they skip unpickling, the last_access update and the process-wide
+    write lock. Entries found only in SQLite, e.g. after a restart, are copied back into memory with the expiry
+    times they had. Only keys accepted by persist(key) reach SQLite; the others, typically values that are cheap
+    to rebuild from persisted ones, only live in memory."""
+
+    def __init__(self, memory, store, persist=None):
+        self.memory = memory
+        self.store = store
+        self.persist = persist if persist is not None else (lambda key: True)
+
+    def lookup(self, key):
+        """Gets a (value, is_stale) tuple, or None if the entry is missing or past its hard expiry"""
+        entry = self.memory.lookup(key)
+        if entry is not None or not self.persist(key):
+            return entry
+        stored = self.store.lookup_entry(key)
+        if stored is None:
+            return None
+        value, fresh_until, expires_at = stored
+        now = time.time()
+        ttl = max(fresh_until - now, 0)
+        self.memory.put(key, value, ttl, stale_ttl=expires_at - now - ttl)
+        return value, now >= fresh_until
+
+    def peek(self, key):
+        """Gets a (value, is_stale) tuple like lookup(), without counting it in either tier"""
+        entry = self.memory.peek(key)
+        if entry is not None or not self.persist(key):
+            return entry
+        return self.store.peek(key)
+
+    def get(self, key):
+        """Gets a cached value, or None if it is missing or no longer fresh"""
+        entry = self.lookup(key)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def put(self, key, value, ttl, stale_ttl=0):
+        """Caches a value in memory, and in SQLite too if persist(key) accepts it"""
+        self.memory.put(key, value, ttl, stale_ttl)
+        if self.persist(key):
+            self.store.put(key, value, ttl, stale_ttl)
+
+    def sweep(self):
+        """Drops every expired entry from both tiers"""
+        return self.memory.sweep() + self.store.sweep()
+
+    def stats(self):
+        """Gets the counters of the memory tier, with those of the SQLite store under its "persistent" key"""
+        counters = self.memory.stats()
+        counters["persistent"] = self.store.stats()
+        return counters
+
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing a key so that only one loader runs at a time
+
+    Callers arriving while a load for the same key is in flight wait for it and get its result; if the
+    loader raises, every waiter gets the same exception."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, loader):
+        """Runs loader for key, or waits for the in-flight run of another thread"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "value": None, "error": None}
+                self._calls[key] = call
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["value"]
+        try:
+            call["value"] = loader()
+            return call["value"]
+        except BaseException as exc:
+            call["error"] = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+
+def create_cache(path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, persist=None):
+    """Creates the configured cache backend: process memory, backed by SQLite when a path is given
+
+    persist(key) picks the keys written to SQLite, see TieredCache; by default every key is."""
+    if path:
+        return TieredCache(MemoryCache(), SqliteCache(path, max_bytes=max_bytes), persist=persist)
+    return MemoryCache()
+
+
+def start_sweeper(cache, interval=SWEEP_INTERVAL_SECONDS):
+    """Starts a daemon thread that periodically drops expired entries from cache"""
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                cache.sweep()
+            except Exception:  # noqa: BLE001 - the sweeper must never die
+                logger.exception("Cache sweep failed")
+
+    thread = threading.Thread(target=sweep_forever, name="cache-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -3,16 +3,17 @@ from urllib.parse import parse_qs, urlparse
 from api import constant
 from api.getters import (
     UpstreamDataError,
-    get_classes,
+    UpstreamUnavailableError,
     get_course_code,
     get_course_list,
     get_course_name,
     get_course_url,
     get_curr_code,
     get_curricula,
+    get_event_uid_namespace,
     get_ical_file,
     get_safe_course_name,
-    get_timetable,
+    get_timetable_bundle,
 )
 from api.http_handler_base import JsonApiHandler
 from api.security import (
@@ -51,13 +52,12 @@ class handler(JsonApiHandler):
                 raise ClientInputError("Parameter '{}' points outside available data".format(constant.ARG_CURR))
 
             curr = get_curr_code(curricula, curr_index)
-            timetable = get_timetable(course_url, year, curr)
-            classes = get_classes(course_url, year, curr)
+            timetable, classes = get_timetable_bundle(course_url, year, curr)
             selected_classes = []
             for i, cur_class in enumerate(classes):
                 if (1 << i) & selected_classes_btm:
                     selected_classes.append(cur_class)
-            calendar = get_ical_file(timetable, selected_classes)
+            calendar = get_ical_file(timetable, selected_classes, get_event_uid_namespace(course_code, year, curr))
 
             self._set_headers(
                 status=200,
@@ -72,6 +72,8 @@ class handler(JsonApiHandler):
             self._json_response({"error": "Origin not allowed"}, status=403)
         except (ClientInputError, IndexError, KeyError) as exc:
             self._json_response({"error": str(exc)}, status=400, cors_origin=cors_origin)
+        except UpstreamUnavailableError:
+            self._json_response({"error": "UniBo is currently unavailable, retry later"}, status=503, cors_origin=cors_origin)
         except UpstreamDataError:
             self._json_response({"error": "Unable to retrieve timetable data from UniBo"}, status=502, cors_origin=cors_origin)
         except Exception:
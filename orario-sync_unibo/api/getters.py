@@ -1,5 +1,9 @@
 import datetime
+import functools
+import hashlib
+import os
 from datetime import timedelta
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
 import dateutil.parser
@@ -8,36 +12,69 @@ from bs4 import BeautifulSoup
 from bs4.dammit import EncodingDetector
 from icalendar import Calendar, Event, Timezone
 
-from api import constant
+from api import constant, metrics, upstream
+from api.timetable import Timetable
+
+try:
+    import lxml  # noqa: F401 - only probed to pick the fastest BeautifulSoup tree builder
+except ImportError:
+    lxml = None
 
 
 REQUEST_TIMEOUT = 30
 TRUSTED_COURSE_HOSTS = {"corsi.unibo.it", "www.corsi.unibo.it"}
+HTML_PARSERS = ("lxml", "html5lib")
+HTML_PARSER = os.getenv("BACKEND_HTML_PARSER", "lxml" if lxml is not None else "html5lib")
+DAYS_OF_WEEK_IT = {day: number for number, day in enumerate(
+    ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica"])}
+
+
+# Courses whose timetable was last found as a legacy page, whose next download can overlap the JSON probe.
+_legacy_timetable_courses = set()
 
 
 class UpstreamDataError(RuntimeError):
     """Raised when upstream UniBo data cannot be fetched or trusted."""
 
 
-def _fetch(url):
-    """Performs an HTTP GET to UniBo endpoints with strict timeout/error handling."""
+class UpstreamUnavailableError(UpstreamDataError):
+    """Raised without contacting UniBo while the circuit breaker of its host is open."""
+
+
+def _fetch(url, parser):
+    """Performs an HTTP GET to UniBo endpoints with strict timeout/error handling.
+
+    Pages parser already has a result for are revalidated with If-None-Match/If-Modified-Since, so an unchanged
+    page costs a 304 and no parsing, see upstream.ResponseStore."""
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT)
+        response = upstream.get_conditional(url, parser, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         return response
+    except upstream.CircuitOpenError as exc:
+        raise UpstreamUnavailableError("Upstream UniBo host is unavailable") from exc
     except requests.RequestException as exc:
         raise UpstreamDataError("Upstream UniBo request failed") from exc
 
 
-def _fetch_json(url):
-    """Fetches and decodes JSON from UniBo endpoints with explicit error mapping."""
-    response = _fetch(url)
+def _fetch_parsed(url, parser):
+    """Fetches a UniBo page and runs parser on it, reusing the previous result if the page did not change."""
+    return upstream.parse_response(url, _fetch(url, parser), parser)
+
+
+@metrics.timed(metrics.STAGE_SECONDS, "parse")
+def _decode_json(response):
+    """Decodes a JSON response with explicit error mapping."""
     try:
         return response.json()
     except ValueError as exc:
         raise UpstreamDataError("Invalid JSON from upstream UniBo endpoint") from exc
 
 
+def _fetch_json(url):
+    """Fetches and decodes JSON from UniBo endpoints with explicit error mapping."""
+    return _fetch_parsed(url, _decode_json)
+
+
 def normalize_course_url(course_url):
     """Returns a canonical, trusted course URL or raises UpstreamDataError."""
     if not isinstance(course_url, str):
@@ -85,28 +122,33 @@ def get_encoding(resp):
     return encoding
 
 
-def get_department_names():
-    """Gets a list of unibo's departments parsing a webpage"""
+@metrics.timed(metrics.STAGE_SECONDS, "parse")
+def make_soup(resp):
+    """Parses an HTML response with the configured tree builder
+
+    lxml is several times faster than html5lib, which stays as the fallback when lxml is not installed.
+    scripts/compare_html_parsers.py checks that both builders extract the same data from saved pages."""
+    return BeautifulSoup(resp.content, from_encoding=get_encoding(resp), features=HTML_PARSER)
+
+
+def parse_department_names(dep_resp):
+    """Extracts the list of departments from the current catalog page"""
     dept_links = []
-    try:
-        dep_resp = _fetch(constant.CATALOGURL)
-        dep_soup = BeautifulSoup(dep_resp.content, from_encoding=get_encoding(dep_resp), features="html5lib")
-        # Current catalog structure: each school/area is exposed as a dropdown button
-        # with a `data-params` attribute containing `schede=<id>`.
-        for button in dep_soup.select("div.dropdown-list h2 button[data-params*='schede=']"):
-            title = button.find("span", class_="title")
-            name = title.get_text(strip=True) if title is not None else button.get_text(strip=True)
-            if name:
-                dept_links.append({constant.NAMEFLD: name})
-    except UpstreamDataError:
-        pass
+    dep_soup = make_soup(dep_resp)
+    # Current catalog structure: each school/area is exposed as a dropdown button
+    # with a `data-params` attribute containing `schede=<id>`.
+    for button in dep_soup.select("div.dropdown-list h2 button[data-params*='schede=']"):
+        title = button.find("span", class_="title")
+        name = title.get_text(strip=True) if title is not None else button.get_text(strip=True)
+        if name:
+            dept_links.append({constant.NAMEFLD: name})
+    return dept_links
 
-    if dept_links:
-        return dept_links
 
-    # Legacy fallback in case UniBo restores old pages/selectors.
-    legacy_resp = _fetch(constant.DEPURL)
-    legacy_soup = BeautifulSoup(legacy_resp.content, from_encoding=get_encoding(legacy_resp), features="html5lib")
+def parse_legacy_department_names(legacy_resp):
+    """Extracts the list of departments from the legacy catalog page"""
+    dept_links = []
+    legacy_soup = make_soup(legacy_resp)
     depts = legacy_soup.find("div", class_="dropdown-list")
     if depts is None:
         return dept_links
@@ -115,9 +157,23 @@ def get_department_names():
         name = title.get_text(strip=True) if title is not None else button.get_text(strip=True)
         if name:
             dept_links.append({constant.NAMEFLD: name})
-
     return dept_links
 
+
+def get_department_names():
+    """Gets a list of unibo's departments parsing a webpage"""
+    dept_links = []
+    try:
+        dept_links = _fetch_parsed(constant.CATALOGURL, parse_department_names)
+    except UpstreamDataError:
+        pass
+
+    if dept_links:
+        return dept_links
+
+    # Legacy fallback in case UniBo restores old pages/selectors.
+    return _fetch_parsed(constant.DEPURL, parse_legacy_department_names)
+
 def get_args_from_url(requestline):
     """Parses arguments from a given URL"""
     line = str(requestline)
@@ -150,6 +206,75 @@ def get_args_from_url(requestline):
             constant.ARG_YEAR: year}
 
 
+def parse_course_list(new_resp):
+    """Extracts the list of courses from a current catalog "elenco" page (see get_course_list())"""
+    courses = []
+    new_soup = make_soup(new_resp)
+    for item in new_soup.select("div.card-list-rounded div.item, div.card-list-abstract div.item"):
+        title = item.select_one("div.title h3")
+        if title is None:
+            continue
+        course_name = title.get_text(strip=True)
+        if not course_name:
+            continue
+        course_type = get_course_type_tag_from_duration(item)
+        if course_type:
+            course_name = "{} {}".format(course_name, course_type)
+
+        course_code = ""
+        add_button = item.find("button", class_="add-favourites")
+        if add_button is not None:
+            course_code = add_button.get("data-codice", "").strip()
+        if not course_code:
+            code_tag = item.select_one("div.title p.tag")
+            if code_tag is not None:
+                course_code = "".join(c for c in code_tag.get_text() if c.isdigit())
+
+        course_link = ""
+        img = item.select_one("div.img-wrap img")
+        if img is not None:
+            src = img.get("src", "")
+            if src:
+                # Card images are served from the canonical course site:
+                # https://corsi.unibo.it/.../@@leadimage/image/unibo
+                try:
+                    course_link = normalize_course_url(src.split("/@@", 1)[0])
+                except UpstreamDataError:
+                    course_link = ""
+        if not course_link:
+            detail_link = item.select_one("p.goto a.umtrack[href]")
+            if detail_link is not None:
+                try:
+                    course_link = normalize_course_url(detail_link.get("href", ""))
+                except UpstreamDataError:
+                    course_link = ""
+
+        if course_code and course_link:
+            courses.append({constant.CODEFLD: course_code, constant.NAMEFLD: course_name,
+                            constant.LINKFLD: course_link})
+    return courses
+
+
+def parse_legacy_course_list(courses_resp):
+    """Extracts the list of courses from a legacy catalog page (see get_course_list())"""
+    courses = []
+    courses_soup = make_soup(courses_resp)
+    course_types = courses_soup.find_all("p", class_="type")
+    course_names = courses_soup.find_all("div", class_="title")
+    course_links = courses_soup.find_all("a", class_="umtrack")
+    for i in zip(course_names, course_links, course_types):
+        course_type = "[" + "".join(c for c in i[2].contents[0] if c.isupper()) + "]"
+        course_name = i[0].contents[1].contents[0] + " " + course_type
+        course_code = "".join(c for c in i[0].contents[3].contents[0] if c.isdigit())
+        try:
+            course_link = normalize_course_url(i[1]["href"])
+        except UpstreamDataError:
+            continue
+        courses.append({constant.CODEFLD: course_code, constant.NAMEFLD: course_name,
+                        constant.LINKFLD: course_link})
+    return courses
+
+
 def get_course_list(school_id):
     """Gets a list of courses for a given department
 
@@ -164,50 +289,7 @@ def get_course_list(school_id):
     # Current catalog endpoint for grouped course cards.
     # UniBo has used both `card-list-rounded` and `card-list-abstract`.
     try:
-        new_resp = _fetch(constant.CATALOGELENCOURLFORMAT.format(school_id))
-        new_soup = BeautifulSoup(new_resp.content, from_encoding=get_encoding(new_resp), features="html5lib")
-        for item in new_soup.select("div.card-list-rounded div.item, div.card-list-abstract div.item"):
-            title = item.select_one("div.title h3")
-            if title is None:
-                continue
-            course_name = title.get_text(strip=True)
-            if not course_name:
-                continue
-            course_type = get_course_type_tag_from_duration(item)
-            if course_type:
-                course_name = "{} {}".format(course_name, course_type)
-
-            course_code = ""
-            add_button = item.find("button", class_="add-favourites")
-            if add_button is not None:
-                course_code = add_button.get("data-codice", "").strip()
-            if not course_code:
-                code_tag = item.select_one("div.title p.tag")
-                if code_tag is not None:
-                    course_code = "".join(c for c in code_tag.get_text() if c.isdigit())
-
-            course_link = ""
-            img = item.select_one("div.img-wrap img")
-            if img is not None:
-                src = img.get("src", "")
-                if src:
-                    # Card images are served from the canonical course site:
-                    # https://corsi.unibo.it/.../@@leadimage/image/unibo
-                    try:
-                        course_link = normalize_course_url(src.split("/@@", 1)[0])
-                    except UpstreamDataError:
-                        course_link = ""
-            if not course_link:
-                detail_link = item.select_one("p.goto a.umtrack[href]")
-                if detail_link is not None:
-                    try:
-                        course_link = normalize_course_url(detail_link.get("href", ""))
-                    except UpstreamDataError:
-                        course_link = ""
-
-            if course_code and course_link:
-                courses.append({constant.CODEFLD: course_code, constant.NAMEFLD: course_name,
-                                constant.LINKFLD: course_link})
+        courses = _fetch_parsed(constant.CATALOGELENCOURLFORMAT.format(school_id), parse_course_list)
     except UpstreamDataError:
         pass
 
@@ -215,22 +297,7 @@ def get_course_list(school_id):
         return courses
 
     # Legacy fallback in case old endpoint/selectors are still available.
-    courses_resp = _fetch(constant.CRSURL + str(school_id))
-    courses_soup = BeautifulSoup(courses_resp.content, from_encoding=get_encoding(courses_resp), features="html5lib")
-    course_types = courses_soup.find_all("p", class_="type")
-    course_names = courses_soup.find_all("div", class_="title")
-    course_links = courses_soup.find_all("a", class_="umtrack")
-    for i in zip(course_names, course_links, course_types):
-        course_type = "[" + "".join(c for c in i[2].contents[0] if c.isupper()) + "]"
-        course_name = i[0].contents[1].contents[0] + " " + course_type
-        course_code = "".join(c for c in i[0].contents[3].contents[0] if c.isdigit())
-        try:
-            course_link = normalize_course_url(i[1]["href"])
-        except UpstreamDataError:
-            continue
-        courses.append({constant.CODEFLD: course_code, constant.NAMEFLD: course_name,
-                        constant.LINKFLD: course_link})
-    return courses
+    return _fetch_parsed(constant.CRSURL + str(school_id), parse_legacy_course_list)
 
 
 def get_course_url(course_list, course_index):
@@ -284,21 +351,24 @@ def get_classes_no_json(course_url, year, curr):
     """Gets a list of classes for courses that do not use a JSON timetable
 
     As of 2018-11-13 their names are the content of <li> tags in a <form> tag with id=constant.CLSNOJSONFORMID"""
-    normalized_course_url = normalize_course_url(course_url)
-    classes_url = constant.TIMETABLEURLFORMATNOJSON[get_course_lang(normalized_course_url)].format(
-        normalized_course_url, year, curr
-    )
-    resp = _fetch(classes_url)
-    soup = BeautifulSoup(resp.content, from_encoding=get_encoding(resp), features="html5lib")
+    return _fetch_timetable_no_json(course_url, year, curr, parser=parse_classes_no_json)
+
+
+def _extract_classes_no_json(soup):
     classes = []
     for li in soup.find("form", id=constant.CLSNOJSONFORMID).find_all("li"):
-        classes.append(li.contents[constant.CLSLABELPOS].contents[0])
+        classes.append(str(li.contents[constant.CLSLABELPOS].contents[0]))
     return classes
 
 
-def get_location_no_json(i, soup):
-    """Gets location info for courses that do not use a JSON timetable"""
-    location_data = soup.find("div", id="panel{}".format(i)).find("div").contents
+def parse_classes_no_json(resp):
+    """Extracts the list of classes from a timetable page of a course that does not use a JSON timetable"""
+    return _extract_classes_no_json(make_soup(resp))
+
+
+def get_location_no_json(panel):
+    """Gets location info for courses that do not use a JSON timetable, given the class\' <div id=panel{index}>"""
+    location_data = panel.find("div").contents
     classroom_name = location_data[0].lstrip().rstrip()
     classroom_info = location_data[1].find("div")
     if classroom_info is not None:
@@ -307,26 +377,26 @@ def get_location_no_json(i, soup):
     return classroom_name
 
 
-def get_class_periods_no_json(i, soup):
+def get_class_periods_no_json(panel):
     """Gets the dates of the first and last lessons of a certain class for courses that do not use a JSON timetable
 
     As of 2018-11-13 they are saved as the content of the first <p> tag inside a <div> with id equal to panel{index}
     Since a class can last two semesters with winter break in between, it returns an array
     """
     periods = []
-    for period in soup.find("div", id="panel{}".format(i)).find_all("p"):
+    for period in panel.find_all("p"):
         periods.append(period.contents[0].split("\n"))
     return periods
 
 
-def get_class_name_no_json(i, soup):
+def get_class_name_no_json(tab):
     """Gets the name of a class for courses that do not use a JSON timetable
 
     As of 2018-11-13 it\'s saved as the content of an <h3> tag with id equal to tab{index}"""
-    return soup.find("h3", id="tab{}".format(i)).find("a").contents[2].lstrip().rstrip()
+    return tab.find("a").contents[2].lstrip().rstrip()
 
 
-def get_lessons_no_json(i, soup):
+def get_lessons_no_json(panel):
     """Gets days of week and times a certain class is held for courses that do not use a JSON timetable
 
         As of 2018-11-13 they are saved as <td> elements inside a <table class=constant.TIMETABLETBLCLASS>
@@ -336,12 +406,14 @@ def get_lessons_no_json(i, soup):
         3) teacher\'s name (df: constant.TEACHERFLD)
         4) blank line
         Returns a dict using 4 keys in the order above (no blank line of course, start and end times are separate)"""
-    class_timetables = soup.find("div", id="panel{}".format(i)).find_all("table", class_=constant.TIMETABLETBLCLASS)
+    class_timetables = panel.find_all("table", class_=constant.TIMETABLETBLCLASS)
     class_lessons = []
 
     for class_timetable in class_timetables:
         period_lessons = []
-        for (j, class_time) in enumerate(class_timetable.find("tbody").find_all("td"), 0):
+        # html5lib adds the <tbody> pages leave implicit, lxml does not: only look inside it when there is one.
+        rows = class_timetable.find("tbody") or class_timetable
+        for (j, class_time) in enumerate(rows.find_all("td"), 0):
             class_info = class_time.contents[0].lstrip().rstrip()
             if j % 4 == 0:
                 lesson = {}
@@ -357,6 +429,50 @@ def get_lessons_no_json(i, soup):
     return class_lessons
 
 
+def _index_elements_by_id(soup, names):
+    """Maps the id of every element named in names to the first such element, in a single traversal"""
+    elements = {}
+    for element in soup.find_all(names, id=True):
+        elements.setdefault((element.name, element["id"]), element)
+    return elements
+
+
+def parse_timetable_no_json(resp):
+    """Extracts both the raw timetable and the list of classes from a timetable page that does not use JSON
+
+    Returns a (raw_timetable, classes) tuple as returned by get_raw_timetable_no_json() and get_classes_no_json().
+    The page is parsed once and the per-class <h3 id=tab{index}>/<div id=panel{index}> elements are indexed in
+    a single pass, so extraction is linear in the size of the page."""
+    soup = make_soup(resp)
+    available_classes = _extract_classes_no_json(soup)
+    elements = _index_elements_by_id(soup, ["h3", "div"])
+    classes = []
+    for i in range(0, len(available_classes)):
+        tab = elements[("h3", "tab{}".format(i))]
+        panel = elements[("div", "panel{}".format(i))]
+        class_name = get_class_name_no_json(tab)
+        class_periods = get_class_periods_no_json(panel)
+        classroom_name = get_location_no_json(panel)
+        class_lessons = get_lessons_no_json(panel)
+        for period, period_lessons in zip(class_periods, class_lessons):
+            _class = {constant.NAMEFLD: class_name, constant.CLSSTARTFLD: period[2].lstrip()[:-2],
+                      constant.CLSENDFLD: period[3].lstrip(), constant.LOCATIONFLD: classroom_name,
+                      constant.LESSONSFLD: period_lessons}
+            classes.append(_class)
+    return classes, available_classes
+
+
+def _get_timetable_no_json_url(course_url, year, curr):
+    normalized_course_url = normalize_course_url(course_url)
+    return constant.TIMETABLEURLFORMATNOJSON[get_course_lang(normalized_course_url)].format(
+        normalized_course_url, year, curr
+    )
+
+
+def _fetch_timetable_no_json(course_url, year, curr, parser=parse_timetable_no_json):
+    return _fetch_parsed(_get_timetable_no_json_url(course_url, year, curr), parser)
+
+
 def get_raw_timetable_no_json(course_url, year, curr):
     """Encodes the timetable of a course that does not use a JSON timetable in a vaguely sane format
 
@@ -367,49 +483,42 @@ def get_raw_timetable_no_json(course_url, year, curr):
     -   constant.LESSONSFLD: array of dicts describing the days and times a certain class is held
     The 4th field\'s dict fields are as returned by get_lessons_no_json()
     """
-    normalized_course_url = normalize_course_url(course_url)
-    timetable_url = constant.TIMETABLEURLFORMATNOJSON[get_course_lang(normalized_course_url)].format(
-        normalized_course_url, year, curr
-    )
-    resp = _fetch(timetable_url)
-    soup = BeautifulSoup(resp.content, from_encoding=get_encoding(resp), features="html5lib")
-    classes = []
-    available_classes = get_classes_no_json(normalized_course_url, year, curr)
-    for i in range(0, len(available_classes)):
-        class_name = get_class_name_no_json(i, soup)
-        class_periods = get_class_periods_no_json(i, soup)
-        classroom_name = get_location_no_json(i, soup)
-        class_lessons = get_lessons_no_json(i, soup)
-        for period, period_lessons in zip(class_periods, class_lessons):
-            _class = {constant.NAMEFLD: class_name, constant.CLSSTARTFLD: period[2].lstrip()[:-2],
-                      constant.CLSENDFLD: period[3].lstrip(), constant.LOCATIONFLD: classroom_name,
-                      constant.LESSONSFLD: period_lessons}
-            classes.append(_class)
-    return classes
+    return _fetch_timetable_no_json(course_url, year, curr)[0]
+
+
+def parse_lesson_datetime(value):
+    """Parses a lesson timestamp from a JSON timetable
+
+    UniBo sends ISO-8601 timestamps, which datetime.fromisoformat parses orders of magnitude faster than
+    dateutil; dateutil is only used for values in any other format"""
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return dateutil.parser.parse(value)
 
 
+@metrics.timed(metrics.STAGE_SECONDS, "encode")
 def encode_json_timetable(raw_timetable):
-    """Encodes a JSON timetable in a vaguely sane format (array of dictionaries with 5 fields)
+    """Encodes a JSON timetable in a vaguely sane format (a Timetable of lessons with 5 fields)
 
-    Dictionary fields:
+    Lesson fields:
     -   constant.NAMEFLD: class name
     -   constant.LSNSTARTFLD: datetime object with lesson start time
     -   constant.LSNENDFLD: datetime object with lesson end time
     -   constant.LOCATIONFLD: where the lesson is held, if available
     -   constant.TEACHERFLD: who holds the lesson, if available
     """
-    lessons = []
+    lessons = Timetable()
     for lesson in raw_timetable:
         title = lesson[constant.TITLE]
         if lesson[constant.ROOMS]:
             location = lesson[constant.ROOMS][0][constant.CLASSROOM] + ", " + lesson[constant.ROOMS][0][constant.CAMPUS]
         else:
             location = constant.NO_LOC_AVAILABLE
-        start = dateutil.parser.parse(lesson[constant.START])
-        end = dateutil.parser.parse(lesson[constant.END])
+        start = parse_lesson_datetime(lesson[constant.START])
+        end = parse_lesson_datetime(lesson[constant.END])
         teacher = lesson[constant.TEACHER]
-        lessons.append({constant.NAMEFLD: title, constant.LSNSTARTFLD: start, constant.LSNENDFLD: end,
-                        constant.LOCATIONFLD: location, constant.TEACHERFLD: teacher})
+        lessons.append(title, start, end, location, teacher)
     return lessons
 
 
@@ -430,10 +539,11 @@ def parse_italian_date(date_str):
     return datetime.datetime(yyyy, mmmm, dd)
 
 
+@metrics.timed(metrics.STAGE_SECONDS, "encode")
 def encode_no_json_timetable(raw_timetable):
     """Encodes a non-JSON timetable in the same vaguely sane format
 
-        Dictionary fields:
+        Lesson fields:
         -   constant.NAMEFLD: class name
         -   constant.LSNSTARTFLD: datetime object with lesson start time
         -   constant.LSNENDFLD: datetime object with lesson end time
@@ -441,118 +551,238 @@ def encode_no_json_timetable(raw_timetable):
         -   constant.TEACHERFLD: who holds the lesson, if available
         """
 
-    lessons = []
+    lessons = Timetable()
     for _class in raw_timetable:
         title = _class[constant.NAMEFLD]
         location = _class[constant.LOCATIONFLD]
         class_first_lesson = parse_italian_date(_class[constant.LSNSTARTFLD])
         class_last_lesson = parse_italian_date(_class[constant.LSNENDFLD])
-        class_period = date_range(class_first_lesson, class_last_lesson)
-        for period_date in class_period:
-            weekday = period_date.weekday()
-            for lesson in _class[constant.LESSONSFLD]:
-                teacher = lesson[constant.TEACHERFLD]
-                starthr = int(lesson[constant.LSNSTARTFLD].split(":")[0])
-                startmm = int(lesson[constant.LSNSTARTFLD].split(":")[1])
-                endhr = int(lesson[constant.LSNENDFLD].split(":")[0])
-                endmm = int(lesson[constant.LSNENDFLD].split(":")[1])
-                lesson_weekday = get_it_dow_number(lesson)
-                if weekday == lesson_weekday:
-                    startdatetime = period_date.replace(hour=starthr, minute=startmm)
-                    enddatetime = period_date.replace(hour=endhr, minute=endmm)
-                    lessons.append(
-                        {constant.NAMEFLD: title, constant.LSNSTARTFLD: startdatetime,
-                         constant.LSNENDFLD: enddatetime,
-                         constant.LOCATIONFLD: location, constant.TEACHERFLD: teacher})
+        # As date_range() did, the day of the last lesson itself is left out.
+        days = (class_last_lesson - class_first_lesson).days
+        if days <= 0:
+            continue
+        first_weekday = class_first_lesson.weekday()
+        slots = []
+        for lesson in _class[constant.LESSONSFLD]:
+            starthr, startmm = _parse_lesson_time(lesson[constant.LSNSTARTFLD])
+            endhr, endmm = _parse_lesson_time(lesson[constant.LSNENDFLD])
+            offset = (get_it_dow_number(lesson) - first_weekday) % 7
+            slots.append((offset, starthr, startmm, endhr, endmm, lesson[constant.TEACHERFLD]))
+        # Sorting by offset alone is stable, so same-day lessons keep their order on the page.
+        slots.sort(key=lambda slot: slot[0])
+        for week_start in range(0, days, 7):
+            for offset, starthr, startmm, endhr, endmm, teacher in slots:
+                if week_start + offset >= days:
+                    continue
+                period_date = class_first_lesson + timedelta(week_start + offset)
+                startdatetime = period_date.replace(hour=starthr, minute=startmm)
+                enddatetime = period_date.replace(hour=endhr, minute=endmm)
+                lessons.append(title, startdatetime, enddatetime, location, teacher)
     return lessons
 
 
-def get_it_dow_number(lesson):
-    days_of_week_it = ["lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica"]
-    return days_of_week_it.index(lesson[constant.DOWFLD].lower())
+def _parse_lesson_time(time_str):
+    """Parses a "HH:MM" lesson time into an (hour, minute) tuple"""
+    hours, minutes = time_str.split(":")[:2]
+    return int(hours), int(minutes)
 
 
-def has_json_timetable(course_url, year, curr):
-    """Checks if a course uses a JSON timetable
+def get_it_dow_number(lesson):
+    """Gets the weekday number (Monday is 0) of a lesson from its Italian day of week"""
+    day = lesson[constant.DOWFLD].lower()
+    if day not in DAYS_OF_WEEK_IT:
+        raise ValueError("Unknown day of week: {}".format(day))
+    return DAYS_OF_WEEK_IT[day]
+
 
-    As of 2018-11-13, if a course uses a JSON timetable it has a <div id="calendar"> in its timetable page"""
+def _fetch_json_timetable(course_url, year, curr, parser=_decode_json):
+    """Fetches and parses a course\'s JSON timetable, returning None if the course does not publish one
 
+    The JSON endpoint answers 404 for courses that still use the legacy HTML timetable, so a single GET
+    both probes the format and downloads the data."""
     normalized_course_url = normalize_course_url(course_url)
-    page_url = constant.TIMETABLEURLFORMAT[get_course_lang(normalized_course_url)].format(
+    timetable_url = constant.TIMETABLEURLFORMAT[get_course_lang(normalized_course_url)].format(
         normalized_course_url, year, curr
     )
     try:
-        resp = requests.get(page_url, timeout=REQUEST_TIMEOUT)
+        resp = upstream.get_conditional(timetable_url, parser, timeout=REQUEST_TIMEOUT)
+    except upstream.CircuitOpenError as exc:
+        raise UpstreamUnavailableError("Upstream UniBo host is unavailable") from exc
     except requests.RequestException as exc:
         raise UpstreamDataError("Upstream UniBo request failed") from exc
     if resp.status_code == 404:
-        return False
+        return None
     if resp.status_code >= 400:
         raise UpstreamDataError("Upstream UniBo request failed")
-    return True
+    return upstream.parse_response(timetable_url, resp, parser)
+
+
+def get_data_version(resp):
+    """Gets when the upstream data in a response last changed, as an aware UTC datetime
+
+    Uses the Last-Modified header if UniBo sends one and the download time otherwise, since a DTSTAMP must be
+    when the data was created. Callers that keep the previous download carry its version over to unchanged
+    lessons with Timetable.keep_version_of()."""
+    last_modified = resp.headers.get("Last-Modified")
+    if last_modified:
+        try:
+            return parsedate_to_datetime(last_modified).astimezone(datetime.timezone.utc)
+        except (TypeError, ValueError):
+            pass
+    return datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+
+def _encode_json_timetable_bundle(resp):
+    """Decodes a JSON timetable response into a (timetable, classes) tuple"""
+    raw_timetable = _decode_json(resp)
+    timetable = encode_json_timetable(raw_timetable)
+    timetable.version = get_data_version(resp)
+    return timetable, sorted(get_classes_json(raw_timetable))
+
+
+def _encode_no_json_timetable_bundle(resp):
+    """Parses a legacy timetable page into a (timetable, classes) tuple"""
+    raw_timetable, classes = parse_timetable_no_json(resp)
+    timetable = encode_no_json_timetable(raw_timetable)
+    timetable.version = get_data_version(resp)
+    return timetable, sorted(classes)
+
+
+def _fetch_any_timetable(course_url, year, curr, json_parser, no_json_parser):
+    """Fetches a course\'s JSON timetable with json_parser, or its legacy timetable page with no_json_parser
+
+    Both downloads only depend on the course, year and curriculum, so for courses whose timetable was last found
+    as a legacy page the legacy page is downloaded concurrently with the JSON probe, and only parsed if the probe
+    still finds no JSON timetable. Other courses only download the legacy page once the probe came back empty, so
+    JSON courses do not pay for a second download nor hold a second slot to the host."""
+    normalized_course_url = normalize_course_url(course_url)
+    no_json_url = _get_timetable_no_json_url(normalized_course_url, year, curr)
+    no_json_resp = None
+    if normalized_course_url in _legacy_timetable_courses:
+        no_json_resp = upstream.submit(_fetch, no_json_url, no_json_parser)
+    result = _fetch_json_timetable(normalized_course_url, year, curr, parser=json_parser)
+    if result is not None:
+        _legacy_timetable_courses.discard(normalized_course_url)
+        return result
+    _legacy_timetable_courses.add(normalized_course_url)
+    resp = no_json_resp.result() if no_json_resp is not None else _fetch(no_json_url, no_json_parser)
+    return upstream.parse_response(no_json_url, resp, no_json_parser)
+
+
+def get_timetable_bundle(course_url, year, curr):
+    """Gets both the encoded timetable and the sorted list of classes of a course with a single timetable download
+
+    Returns a (timetable, classes) tuple, where timetable is as returned by get_timetable() and classes as returned
+    by get_classes()"""
+    return _fetch_any_timetable(course_url, year, curr, _encode_json_timetable_bundle,
+                                _encode_no_json_timetable_bundle)
 
 
 def get_timetable(course_url, year, curr):
     """Checks if the selected course uses a JSON calendar and calls the appropriate get_timetable function"""
-    normalized_course_url = normalize_course_url(course_url)
-    if has_json_timetable(normalized_course_url, year, curr):
-        timetable_url = constant.TIMETABLEURLFORMAT[get_course_lang(normalized_course_url)].format(
-            normalized_course_url, year, curr
-        )
-        timetable = encode_json_timetable(_fetch_json(timetable_url))
-    else:
-        raw_timetable = get_raw_timetable_no_json(normalized_course_url, year, curr)
-        timetable = encode_no_json_timetable(raw_timetable)
-    return timetable
+    return get_timetable_bundle(course_url, year, curr)[0]
 
 
-def get_classes_json(course_url, year, curr):
-    """Gets a list of classes from a JSON timetable
+def get_classes_json(raw_timetable):
+    """Gets a list of classes from a decoded JSON timetable
 
     As of 2020-09-28, JSON timetables do not have a list of classes anymore, so we have to traverse the
 	array of classes, get their names and remove duplicates"""
-    normalized_course_url = normalize_course_url(course_url)
-    resp = _fetch_json(
-        constant.TIMETABLEURLFORMAT[get_course_lang(normalized_course_url)].format(normalized_course_url, year, curr)
-    )
     classes = []
-    for _class in resp:
+    for _class in raw_timetable:
         classes.append(_class[constant.TITLE])
     return list(set(classes))
 
 
 
+def _parse_classes_json(resp):
+    return sorted(get_classes_json(_decode_json(resp)))
+
+
+def _parse_sorted_classes_no_json(resp):
+    return sorted(parse_classes_no_json(resp))
+
+
 def get_classes(course_url, year, curr):
     """Checks if the selected course uses a JSON calendar and calls the appropriate get_classes() function"""
-    if has_json_timetable(course_url, year, curr):
-        return sorted(get_classes_json(course_url, year, curr))
-    else:
-        return sorted(get_classes_no_json(course_url, year, curr))
+    return _fetch_any_timetable(course_url, year, curr, _parse_classes_json, _parse_sorted_classes_no_json)
+
+
+
 
+CALENDAR_END = b"END:VCALENDAR\r\n"
 
 
+@functools.lru_cache(maxsize=None)
+def get_calendar_header():
+    """Gets the serialized VCALENDAR properties and VTIMEZONE that open every generated iCalendar file
 
-def get_ical_file(timetable, classes):
-    """Creates an iCalendar file with the timetable as [requested"""
+    The time zone definition never changes, so it is parsed and serialized only once per process."""
     cal = Calendar()
-    timezone = Timezone.from_ical(constant.TIMEZONESTR)
-    cal.add_component(timezone)
+    cal.add_component(Timezone.from_ical(constant.TIMEZONESTR))
     cal.add("prodid", "//kmfrick//orario-sync//IT")
     cal.add("version", "1.0")
-    i = 0
-    for lesson in timetable:
-        if lesson[constant.NAMEFLD] in classes:
-            event = Event()
-            event.add("uid", str(datetime.datetime.now()) + "@OrarioSync" + str(i))
-            i = i + 1
-            event.add("dtstamp", datetime.datetime.now())
-            event.add(constant.ICALTITLE, lesson[constant.NAMEFLD])
-            event.add(constant.ICALSTART, lesson[constant.LSNSTARTFLD], parameters={'tzid': constant.TIMEZONE})
-            event.add(constant.ICALEND, lesson[constant.LSNENDFLD], parameters={'tzid': constant.TIMEZONE})
-            event.add(constant.ICALLOCATION, lesson[constant.LOCATIONFLD])
-            event.add("description", lesson[constant.TEACHERFLD])
-            cal.add_component(event)
-    return cal.to_ical()
+    serialized = cal.to_ical()
+    return serialized[:-len(CALENDAR_END)]
+
+
+def get_event_uid_namespace(course_code, year, curr):
+    """Gets the prefix of the UIDs of the events generated for a course, year and curriculum"""
+    return "{}-{}-{}".format(course_code, year, curr)
+
+
+def iter_class_events(timetable, class_name, uid_namespace=""):
+    """Serializes the lessons of a class one VEVENT component at a time
+
+    UIDs are derived from uid_namespace, the class name and the start of the lesson, and DTSTAMP is the version
+    of the upstream data, so rendering the same timetable always gives the same bytes and a lesson keeps its UID
+    across downloads."""
+    class_key = hashlib.sha1(class_name.encode("utf-8")).hexdigest()[:12]
+    dtstamp = timetable.version or datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    starts_seen = {}
+    for lesson in timetable.select([class_name]):
+        start = lesson[constant.LSNSTARTFLD].strftime("%Y%m%dT%H%M%S")
+        # Lessons of a class starting together (e.g. split across rooms) are told apart by their order.
+        repeat = starts_seen[start] = starts_seen.get(start, -1) + 1
+        event = Event()
+        event.add("uid", "{}-{}-{}{}@OrarioSync".format(
+            uid_namespace, class_key, start, "-{}".format(repeat) if repeat else ""))
+        event.add("dtstamp", dtstamp)
+        event.add(constant.ICALTITLE, lesson[constant.NAMEFLD])
+        event.add(constant.ICALSTART, lesson[constant.LSNSTARTFLD], parameters={'tzid': constant.TIMEZONE})
+        event.add(constant.ICALEND, lesson[constant.LSNENDFLD], parameters={'tzid': constant.TIMEZONE})
+        event.add(constant.ICALLOCATION, lesson[constant.LOCATIONFLD])
+        event.add("description", lesson[constant.TEACHERFLD])
+        yield event.to_ical()
+
+
+@metrics.timed(metrics.STAGE_SECONDS, "render")
+def render_class_events(timetable, class_name, uid_namespace=""):
+    """Serializes the lessons of a class as a block of VEVENT components, which can be cached and streamed with
+    iter_ical_file()"""
+    return b"".join(iter_class_events(timetable, class_name, uid_namespace))
+
+
+def iter_ical_file(event_blocks):
+    """Yields an iCalendar file piece by piece: the header, each VEVENT block as it is produced, the footer
+
+    Nothing but the current block is held in memory, so the file can be streamed however many lessons it has."""
+    yield get_calendar_header()
+    for block in event_blocks:
+        yield block
+    yield CALENDAR_END
+
+
+def stream_ical_file(timetable, classes, uid_namespace=""):
+    """Yields the iCalendar file get_ical_file() returns, one VEVENT at a time"""
+    return iter_ical_file(event for class_name in dict.fromkeys(classes)
+                          for event in iter_class_events(timetable, class_name, uid_namespace))
+
+
+@metrics.timed(metrics.STAGE_SECONDS, "render")
+def get_ical_file(timetable, classes, uid_namespace=""):
+    """Creates an iCalendar file with the lessons of the requested classes of a Timetable"""
+    return b"".join(stream_ical_file(timetable, classes, uid_namespace))
 
 
 def get_safe_course_name(name):
@@ -0,0 +1,175 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name = "{}{{{}}}".format(name, ",".join('{}="{}"'.format(label, _escape(_format_value(v)))
+                                                for label, v in labels))
+    return "{} {}".format(name, _format_value(value))
+
+
+def _format_family(name, kind, help_text, samples):
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+    lines.extend(_format_sample(*sample) for sample in samples)
+    return lines
+
+
+class Counter:
+    """Counter with one value per combination of label values, registered for render() when created"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """Yields (name, labels, value) tuples, labels being a tuple of (label name, label value) pairs"""
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    """Value that can go up and down, such as the number of requests in flight"""
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    """Distribution of observed durations in cumulative buckets, as Prometheus histograms expect them"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Observes the time spent inside the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(series[0]), series[1], series[2]))
+                            for labels, series in self._values.items())
+        for labels, (counts, total, count) in values:
+            labels = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", labels + (("le", bound),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+def timed(histogram, *labels):
+    """Decorates a function so that each call is observed by histogram"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(*labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def stats_samples(prefix, stats, labels=()):
+    """Turns a stats() dict into (name, labels, value) samples named prefix_<key>
+
+    Nested dicts become labelled series: the first level is labelled with the names in labels, in order.
+    String values are exported as a sample with value 1 and the string in a `value` label; None is skipped."""
+    samples = {}
+
+    def collect(values, label_values):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                collect(value, label_values + ((labels[len(label_values)], key),))
+            elif isinstance(value, bool) or value is None:
+                continue
+            elif isinstance(value, str):
+                samples.setdefault(prefix + "_" + key, []).append((label_values + (("value", value),), 1))
+            else:
+                samples.setdefault(prefix + "_" + key, []).append((label_values, value))
+
+    collect(stats, ())
+    return samples
+
+
+def render(stats_families=()):
+    """Renders every registered metric, then the given stats families, in the Prometheus text exposition format
+
+    stats_families is an iterable of (prefix, help text, stats dict, label names) tuples; each key of a stats
+    dict becomes an untyped metric, see stats_samples()."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        samples = list(metric.samples())
+        if samples:
+            lines.extend(_format_family(metric.name, metric.kind, metric.help_text, samples))
+    for prefix, help_text, stats, labels in stats_families:
+        for name, series in sorted(stats_samples(prefix, stats, labels).items()):
+            lines.extend(_format_family(name, "untyped", help_text,
+                                        ((name, label_values, value) for label_values, value in series)))
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("orariosync_stage_seconds",
+                          "Time spent in each stage of building a response: parse, encode, render, serialize",
+                          ("stage",))
+UPSTREAM_REQUEST_SECONDS = Histogram("orariosync_upstream_request_seconds",
+                                     "Duration of requests to UniBo, once a slot to the host was acquired",
+                                     ("host",))
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import heapq
+from array import array
+from collections.abc import Mapping, Sequence
+
+from api import constant
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+LESSON_FIELDS = (constant.NAMEFLD, constant.LSNSTARTFLD, constant.LSNENDFLD, constant.LOCATIONFLD,
+                 constant.TEACHERFLD)
+
+
+class Timetable(Sequence):
+    """Compact, struct-of-arrays storage for the lessons of an encoded timetable
+
+    Start and end times are kept as wall-clock microseconds since the epoch in typed arrays; class names,
+    locations, teachers and time zones are interned into per-timetable tables and referenced by index.
+    Items are Lesson views that read like the five-field lesson dicts returned by earlier versions.
+    The positions of each class' lessons are indexed as they are appended, so select() only touches the
+    lessons of the requested classes. version is the datetime of the upstream data the timetable was built from,
+    if known."""
+
+    __slots__ = ("_strings", "_string_ids", "_tzinfos", "_names", "_locations", "_teachers", "_starts", "_ends",
+                 "_tzs", "_class_lessons", "_digest", "version")
+
+    def __init__(self):
+        self._strings = []
+        self._string_ids = {}
+        self._tzinfos = [None]
+        self._names = array("I")
+        self._locations = array("I")
+        self._teachers = array("I")
+        self._starts = array("q")
+        self._ends = array("q")
+        self._tzs = array("B")
+        self._class_lessons = {}
+        self._digest = None
+        self.version = None
+
+    def __getstate__(self):
+        # The string id lookup is only needed while appending and is rebuilt on demand.
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "_string_ids"}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._string_ids = None
+
+    def _intern(self, value):
+        if self._string_ids is None:
+            self._string_ids = {string: i for i, string in enumerate(self._strings)}
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(value)
+            self._string_ids[value] = string_id
+        return string_id
+
+    def _encode_datetime(self, value):
+        tzinfo = value.tzinfo
+        if tzinfo is None:
+            tz_id = 0
+        else:
+            if tzinfo not in self._tzinfos:
+                self._tzinfos.append(tzinfo)
+            tz_id = self._tzinfos.index(tzinfo)
+        return (value.replace(tzinfo=None) - EPOCH) // MICROSECOND, tz_id
+
+    def _decode_datetime(self, microseconds, tz_id):
+        value = EPOCH + datetime.timedelta(microseconds=microseconds)
+        if tz_id:
+            value = value.replace(tzinfo=self._tzinfos[tz_id])
+        return value
+
+    def append(self, name, start, end, location, teacher):
+        """Adds a lesson; start and end are datetime objects, which must share the same time zone"""
+        start_us, tz_id = self._encode_datetime(start)
+        end_us, _ = self._encode_datetime(end)
+        self._names.append(self._intern(name))
+        self._locations.append(self._intern(location))
+        self._teachers.append(self._intern(teacher))
+        self._starts.append(start_us)
+        self._ends.append(end_us)
+        self._tzs.append(tz_id)
+        positions = self._class_lessons.get(name)
+        if positions is None:
+            positions = self._class_lessons[name] = array("I")
+        positions.append(len(self._starts) - 1)
+        self._digest = None
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Timetable index out of range")
+        return Lesson(self, index)
+
+    def digest(self):
+        """Gets a hash of the lessons, which changes whenever the timetable content does"""
+        if self._digest is None:
+            content = hashlib.sha256()
+            content.update(repr((self._strings, [str(tzinfo) for tzinfo in self._tzinfos])).encode("utf-8"))
+            for column in (self._names, self._locations, self._teachers, self._starts, self._ends, self._tzs):
+                content.update(column.tobytes())
+            self._digest = content.hexdigest()
+        return self._digest
+
+    def keep_version_of(self, previous):
+        """Keeps the data version of a previous download of the same timetable if its lessons did not change
+
+        If they did change, the version is moved past the previous one when it is not later already, so the
+        DTSTAMPs clients order updates by never go back."""
+        if previous is None or previous.version is None:
+            return
+        if previous.digest() == self.digest():
+            self.version = previous.version
+        elif self.version is None or self.version <= previous.version:
+            self.version = previous.version + datetime.timedelta(seconds=1)
+
+    def select(self, classes):
+        """Iterates, in timetable order, over the lessons of the given classes only"""
+        selected = [self._class_lessons[name] for name in set(classes) if name in self._class_lessons]
+        for index in heapq.merge(*selected):
+            yield Lesson(self, index)
+
+    def get_field(self, index, field):
+        """Gets a single field of a lesson, decoding it as the lesson dicts did"""
+        if field == constant.NAMEFLD:
+            return self._strings[self._names[index]]
+        if field == constant.LSNSTARTFLD:
+            return self._decode_datetime(self._starts[index], self._tzs[index])
+        if field == constant.LSNENDFLD:
+            return self._decode_datetime(self._ends[index], self._tzs[index])
+        if field == constant.LOCATIONFLD:
+            return self._strings[self._locations[index]]
+        if field == constant.TEACHERFLD:
+            return self._strings[self._teachers[index]]
+        raise KeyError(field)
+
+
+class Lesson(Mapping):
+    """Read-only view of one lesson of a Timetable, with the fields of the old lesson dicts"""
+
+    __slots__ = ("_timetable", "_index")
+
+    def __init__(self, timetable, index):
+        self._timetable = timetable
+        self._index = index
+
+    def __getitem__(self, field):
+        return self._timetable.get_field(self._index, field)
+
+    def __iter__(self):
+        return iter(LESSON_FIELDS)
+
+    def __len__(self):
+        return len(LESSON_FIELDS)
+
+    def __repr__(self):
+        return "Lesson({!r})".format(dict(self))
@@ -0,0 +1,439 @@
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from api import metrics
+from api.cache import MemoryCache
+
+try:
+    import brotli  # noqa: F401 - only needed so urllib3 can decode `br` responses
+except ImportError:
+    brotli = None
+
+
+POOL_HOSTS = int(os.getenv("BACKEND_UPSTREAM_POOL_HOSTS", "4"))
+POOL_SIZE_PER_HOST = int(os.getenv("BACKEND_UPSTREAM_POOL_SIZE", "8"))
+RETRY_COUNT = int(os.getenv("BACKEND_UPSTREAM_RETRIES", "2"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("BACKEND_UPSTREAM_RETRY_BACKOFF_SECONDS", "0.5"))
+RETRY_STATUSES = (500, 502, 503, 504)
+STORE_MAX_ENTRIES = int(os.getenv("BACKEND_UPSTREAM_STORE_ENTRIES", "64"))
+STORE_TTL_SECONDS = 7 * 24 * 3600
+ACCEPT_ENCODING = "gzip, br" if brotli is not None else "gzip"
+MAX_IN_FLIGHT_PER_HOST = int(os.getenv("BACKEND_UPSTREAM_MAX_IN_FLIGHT", "4"))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("BACKEND_UPSTREAM_QUEUE_TIMEOUT_SECONDS", "10"))
+BREAKER_WINDOW = int(os.getenv("BACKEND_UPSTREAM_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BACKEND_UPSTREAM_BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATIO = float(os.getenv("BACKEND_UPSTREAM_BREAKER_FAILURE_RATIO", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BACKEND_UPSTREAM_BREAKER_SLOW_CALL_SECONDS", "10"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BACKEND_UPSTREAM_BREAKER_OPEN_SECONDS", "30"))
+PARALLEL_FETCHES = int(os.getenv("BACKEND_UPSTREAM_PARALLEL_FETCHES", "4"))
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+CIRCUIT_COUNTERS = {CIRCUIT_CLOSED: "circuit_closed", CIRCUIT_OPEN: "circuit_opened",
+                    CIRCUIT_HALF_OPEN: "circuit_half_opened"}
+
+# Lower values are served first when requests to a host queue up.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class UpstreamQueueTimeout(requests.RequestException):
+    """Raised when a request waited longer than the queue timeout for a free slot to its host"""
+
+
+class HostLimiter:
+    """Caps the requests in flight to one upstream host, queuing the others by priority, then arrival
+
+    A waiter that does not get a slot within timeout gives up with UpstreamQueueTimeout, so a slow host
+    cannot tie up every server thread."""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT_PER_HOST, timeout=QUEUE_TIMEOUT_SECONDS):
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._counters = {"acquired": 0, "queued": 0, "timeouts": 0, "max_queue_depth": 0,
+                          "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def _grant_next(self):
+        # Called with the lock held whenever a slot frees up.
+        while self._waiters and self._in_flight < self.max_in_flight:
+            _, _, granted = heapq.heappop(self._waiters)
+            self._in_flight += 1
+            granted.set()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        started = time.monotonic()
+        with self._lock:
+            self._counters["acquired"] += 1
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                return
+            granted = threading.Event()
+            waiter = (priority, next(self._sequence), granted)
+            heapq.heappush(self._waiters, waiter)
+            self._counters["queued"] += 1
+            self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], len(self._waiters))
+        granted.wait(self.timeout)
+        waited = time.monotonic() - started
+        with self._lock:
+            self._counters["wait_seconds_total"] += waited
+            self._counters["wait_seconds_max"] = max(self._counters["wait_seconds_max"], waited)
+            if granted.is_set():
+                return
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            self._counters["timeouts"] += 1
+        raise UpstreamQueueTimeout("No upstream slot freed up within {} s".format(self.timeout))
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._grant_next()
+
+    def stats(self):
+        """Gets the current in-flight count and queue depth, and cumulative wait counters"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters["in_flight"] = self._in_flight
+            counters["queue_depth"] = len(self._waiters)
+        return counters
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of sending a request to a host whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops sending requests to an upstream host that keeps failing or answering too slowly
+
+    While closed, the outcome of the last `window` requests is recorded; a request fails if it raises, gets a
+    5xx or takes longer than slow_call_seconds. Once at least min_calls outcomes are known and the failing
+    share reaches failure_ratio, the circuit opens and requests fail at once with CircuitOpenError. After
+    open_seconds it turns half-open and lets a single probe through: success closes it, failure reopens it."""
+
+    def __init__(self, host, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_ratio=BREAKER_FAILURE_RATIO,
+                 slow_call_seconds=BREAKER_SLOW_CALL_SECONDS, open_seconds=BREAKER_OPEN_SECONDS):
+        self.host = host
+        self.min_calls = max(1, min_calls)
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=max(1, window))
+        self._state = CIRCUIT_CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._counters = {"circuit_opened": 0, "circuit_half_opened": 0, "circuit_closed": 0, "circuit_rejected": 0}
+
+    def _set_state(self, state):
+        # Called with the lock held.
+        self._state = state
+        self._counters[CIRCUIT_COUNTERS[state]] += 1
+
+    def allow(self):
+        """Checks that a request may be sent, raising CircuitOpenError otherwise"""
+        with self._lock:
+            if self._state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._set_state(CIRCUIT_HALF_OPEN)
+            if self._state == CIRCUIT_CLOSED:
+                return
+            if self._state == CIRCUIT_HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self._counters["circuit_rejected"] += 1
+            retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError("Circuit for {} is open, retry in {:.0f} s".format(self.host, retry_in))
+
+    def cancel(self):
+        """Hands back a request that allow() let through but that was never sent"""
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._probing = False
+
+    def record(self, failed, elapsed):
+        """Records the outcome of a request that allow() let through"""
+        failed = failed or elapsed > self.slow_call_seconds
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._probing = False
+                self._outcomes.clear()
+                if failed:
+                    self._opened_at = time.monotonic()
+                    self._set_state(CIRCUIT_OPEN)
+                else:
+                    self._set_state(CIRCUIT_CLOSED)
+                return
+            if self._state != CIRCUIT_CLOSED:
+                return
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self._outcomes):
+                self._outcomes.clear()
+                self._opened_at = time.monotonic()
+                self._set_state(CIRCUIT_OPEN)
+
+    def stats(self):
+        """Gets the circuit state (closed, open or half_open) and how often it changed and rejected requests"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters["circuit_state"] = self._state
+            counters["circuit_failure_ratio"] = sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+        return counters
+
+
+_limiters = {}
+_breakers = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    """Gets the limiter of an upstream host, creating it on first use"""
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter()
+        return limiter
+
+
+def get_breaker(host):
+    """Gets the circuit breaker of an upstream host, creating it on first use"""
+    with _limiters_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+def current_priority():
+    """Gets the priority of the upstream requests made by the calling thread"""
+    return getattr(_local, "priority", PRIORITY_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Runs the upstream requests made by the calling thread inside the block at the given priority"""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def _build_adapter():
+    """Builds the connection-pooling adapter shared by every upstream session"""
+    retries = Retry(
+        total=RETRY_COUNT,
+        connect=RETRY_COUNT,
+        read=RETRY_COUNT,
+        status=RETRY_COUNT,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        backoff_factor=RETRY_BACKOFF_SECONDS,
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE_PER_HOST, pool_block=False,
+                       max_retries=retries)
+
+
+_adapter = _build_adapter()
+_local = threading.local()
+_fetch_executor = ThreadPoolExecutor(max_workers=max(1, PARALLEL_FETCHES), thread_name_prefix="upstream-fetch")
+
+
+def _run_at_priority(priority, fn, args):
+    with request_priority(priority):
+        return fn(*args)
+
+
+def submit(fn, *args):
+    """Starts fn(*args) on the shared fetch pool, so independent upstream requests can overlap
+
+    The requests it makes keep the priority of the calling thread. Returns a concurrent.futures.Future; fn
+    must not wait on other submitted calls itself, or a busy pool could deadlock."""
+    return _fetch_executor.submit(_run_at_priority, current_priority(), fn, args)
+
+
+def get_session():
+    """Gets the calling thread's upstream session
+
+    requests.Session objects are not guaranteed to be thread-safe, so each thread gets its own session.
+    All of them mount the same adapter, whose urllib3 pools are thread-safe, so keep-alive connections
+    to corsi.unibo.it and www.unibo.it are shared across server worker threads."""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        session.mount("https://", _adapter)
+        session.mount("http://", _adapter)
+        _local.session = session
+    return session
+
+
+def get(url, **kwargs):
+    """Performs a GET through the pooled upstream session, once its host has a free slot
+
+    Fails at once with CircuitOpenError, without queuing, while the circuit breaker of the host is open."""
+    host = urlparse(url).hostname
+    breaker = get_breaker(host)
+    breaker.allow()
+    limiter = get_limiter(host)
+    try:
+        limiter.acquire(current_priority())
+    except UpstreamQueueTimeout:
+        # Local congestion says nothing about the host, but a half-open probe slot must be handed back.
+        breaker.cancel()
+        raise
+    started = time.monotonic()
+    failed = True
+    try:
+        response = get_session().get(url, **kwargs)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        elapsed = time.monotonic() - started
+        limiter.release()
+        breaker.record(failed, elapsed)
+        metrics.UPSTREAM_REQUEST_SECONDS.observe(elapsed, host)
+
+
+def stats():
+    """Gets per-host connection reuse and queuing counters of upstream requests
+
+    Returns a dict mapping host to a dict with the number of requests sent, connections opened and
+    requests served on an already open (reused) connection, merged with the HostLimiter.stats() and
+    CircuitBreaker.stats() of the host."""
+    pools = _adapter.poolmanager.pools
+    per_host = {}
+    with _limiters_lock:
+        limiters = dict(_limiters)
+        breakers = dict(_breakers)
+    for host, limiter in limiters.items():
+        per_host[host] = limiter.stats()
+    for host, breaker in breakers.items():
+        per_host.setdefault(host, {}).update(breaker.stats())
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host_stats = per_host.setdefault(pool.host, {})
+        for counter in ("requests", "connections_opened", "connections_reused"):
+            host_stats.setdefault(counter, 0)
+        host_stats["requests"] += pool.num_requests
+        host_stats["connections_opened"] += pool.num_connections
+        host_stats["connections_reused"] += max(pool.num_requests - pool.num_connections, 0)
+    return per_host
+
+
+class Revalidated:
+    """Stands for an upstream response answered with 304 Not Modified, carrying the result parsed from the body
+    of the response it revalidated"""
+
+    status_code = 304
+
+    def __init__(self, url, result):
+        self.url = url
+        self.result = result
+
+    def raise_for_status(self):
+        pass
+
+
+class ResponseStore:
+    """Keeps the validators (ETag/Last-Modified) of the last 200 response of each URL with the result parsed from it
+
+    Response bodies are never kept: only what each parser extracted, so a 304 is answered with the parsed result
+    instead of parsing again. Entries live in a cache backend under the "upstream" family, so they count against
+    its size limits and are evicted with its other entries; by default a private MemoryCache of max_entries.
+    Only responses carrying an ETag or Last-Modified header are kept, since nothing else can be revalidated."""
+
+    def __init__(self, cache=None, max_entries=STORE_MAX_ENTRIES):
+        self.cache = cache if cache is not None else MemoryCache(max_entries=max_entries)
+        self._lock = threading.Lock()
+        self._counters = {"revalidated": 0, "modified": 0, "lost": 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    @staticmethod
+    def _key(url, parser):
+        return "upstream", url, parser
+
+    def conditional_headers(self, url, parser):
+        """Gets the If-None-Match/If-Modified-Since headers for a URL whose page parser has a stored result for"""
+        entry = self.cache.get(self._key(url, parser))
+        if entry is None:
+            return {}
+        validators, _ = entry
+        headers = {}
+        if validators.get("ETag"):
+            headers["If-None-Match"] = validators["ETag"]
+        if validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+        return headers
+
+    def get(self, url, parser, **kwargs):
+        """Performs a GET revalidating the result parser has stored for url; a 304 is answered with a Revalidated
+
+        A 304 whose stored result was evicted in the meantime has no body to parse, so it is retried
+        unconditionally."""
+        headers = dict(kwargs.pop("headers", None) or {})
+        conditional = self.conditional_headers(url, parser)
+        response = get(url, headers=dict(headers, **conditional), **kwargs)
+        if not conditional:
+            return response
+        if response.status_code == 304:
+            entry = self.cache.peek(self._key(url, parser))
+            if entry is not None:
+                self._count("revalidated")
+                return Revalidated(url, entry[0][1])
+            self._count("lost")
+            return get(url, headers=headers, **kwargs)
+        if response.status_code == 200:
+            self._count("modified")
+        return response
+
+    def parse(self, url, response, parser):
+        """Runs parser on response, or gets the stored result of a Revalidated response, storing the new result"""
+        if isinstance(response, Revalidated):
+            return response.result
+        result = parser(response)
+        validators = {name: response.headers.get(name) for name in ("ETag", "Last-Modified")}
+        if response.status_code == 200 and any(validators.values()):
+            self.cache.put(self._key(url, parser), (validators, result), STORE_TTL_SECONDS)
+        return result
+
+    def stats(self):
+        """Gets revalidation counters: 304s answered from a stored result, changed pages, and 304s whose stored
+        result was evicted while the request was in flight"""
+        with self._lock:
+            return dict(self._counters)
+
+
+response_store = ResponseStore()
+
+
+def get_conditional(url, parser, **kwargs):
+    """Performs a GET revalidating the result parser has stored for url, see ResponseStore.get()"""
+    return response_store.get(url, parser, **kwargs)
+
+
+def parse_response(url, response, parser):
+    """Parses an upstream response, reusing the parsed result of a revalidated body"""
+    return response_store.parse(url, response, parser)
@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from api.getters import get_course_code, get_curr_code
+
+
+WARMER_CONCURRENCY = int(os.getenv("BACKEND_WARMER_CONCURRENCY", "2"))
+WARMER_RATE_PER_SECOND = float(os.getenv("BACKEND_WARMER_RATE_PER_SECOND", "1"))
+WARMER_INTERVAL_SECONDS = int(os.getenv("BACKEND_WARMER_INTERVAL_SECONDS", "21600"))
+WARMER_STATE_PATH = os.getenv("BACKEND_WARMER_STATE_PATH", "")
+WARMER_PRIORITY = os.getenv("BACKEND_WARMER_PRIORITY", "recent")
+WARMER_PRIORITIES = ("recent", "catalog")
+# Share of the memory cache a pass may fill when there is no persistent tier to hold the rest.
+WARMER_MEMORY_FRACTION = float(os.getenv("BACKEND_WARMER_MEMORY_FRACTION", "0.5"))
+
+# Mirrors COURSE_TYPE_BY_DURATION in src/courseUtils.js, which decides which years the frontend offers.
+COURSE_YEARS_BY_TYPE = {"[LMCU]": 6, "[L]": 3, "[LM]": 2}
+DEFAULT_COURSE_YEARS = 6
+
+# Lower values run first. Deeper catalog levels go before shallower ones, so the walk is depth-first
+# and whole courses get warm before the queue fans out to the next school.
+PRIORITY_RECENT = 0
+PRIORITY_TIMETABLE = 1
+PRIORITY_CURRICULA = 2
+PRIORITY_COURSES = 3
+PRIORITY_SCHOOLS = 4
+
+STATE_SAVE_EVERY = 10
+
+logger = logging.getLogger(__name__)
+
+
+def course_year_count(course):
+    """Gets the number of years a course lasts from the type tag appended to its name by get_course_list()"""
+    name = course.get("name", "")
+    for course_type, years in COURSE_YEARS_BY_TYPE.items():
+        if name.endswith(course_type):
+            return years
+    return DEFAULT_COURSE_YEARS
+
+
+class CacheWarmer:
+    """Walks the UniBo catalog down to every timetable, filling the server cache through source
+
+    source must provide load_schools(), load_course_list(school_index),
+    load_curricula(school_index, course_code, year),
+    load_timetable_bundle(school_index, course_code, year, curr_code) and recent_timetables(), which returns
+    the (school_index, course_code, year, curr_code) tuples users asked for most recently.
+    Task starts are rate limited and at most `concurrency` tasks run at once; a pass starts at most `max_tasks`
+    tasks, if set. Warmed timetables are recorded by code in the optional state file, so a restarted pass skips
+    them even if UniBo reordered the catalog in between."""
+
+    def __init__(self, source, concurrency=WARMER_CONCURRENCY, rate_per_second=WARMER_RATE_PER_SECOND,
+                 state_path=WARMER_STATE_PATH, priority=WARMER_PRIORITY, interval=WARMER_INTERVAL_SECONDS,
+                 max_tasks=None):
+        if priority not in WARMER_PRIORITIES:
+            raise ValueError("Unknown warmer priority: {}".format(priority))
+        self.source = source
+        self.concurrency = max(1, concurrency)
+        self.min_start_interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self.state_path = state_path
+        self.priority = priority
+        self.interval = interval
+        self.max_tasks = max_tasks
+        self._cond = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._seen = set()
+        self._done = set()
+        self._active = 0
+        self._budget = None
+        self._next_start = 0.0
+        self._rate_lock = threading.Lock()
+        self._pass_started_at = None
+        self._counters = {"passes_completed": 0, "tasks_queued": 0, "tasks_done": 0, "tasks_failed": 0,
+                          "tasks_skipped": 0, "tasks_over_budget": 0, "timetables_warmed": 0}
+        self._last_pass_completed_at = None
+
+    def stats(self):
+        """Gets progress counters of the current pass and of the passes completed so far"""
+        with self._cond:
+            counters = dict(self._counters)
+            counters["queue_depth"] = len(self._queue)
+            counters["active_tasks"] = self._active
+            counters["pass_started_at"] = self._pass_started_at
+            counters["last_pass_completed_at"] = self._last_pass_completed_at
+        return counters
+
+    def _load_state(self, now):
+        if not self.state_path:
+            return None
+        try:
+            with open(self.state_path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return None
+        started_at = state.get("pass_started_at")
+        if state.get("completed_at") is not None or not started_at or now - started_at >= self.interval:
+            return None
+        return state
+
+    def _save_state(self, completed=False):
+        if not self.state_path:
+            return
+        with self._cond:
+            state = {
+                "pass_started_at": self._pass_started_at,
+                "completed_at": time.time() if completed else None,
+                "done": [] if completed else sorted(self._done),
+            }
+        tmp_path = "{}.tmp".format(self.state_path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as exc:
+            logger.warning("Unable to save warmer state: %s", exc)
+
+    def _push(self, priority, task):
+        with self._cond:
+            if task in self._seen:
+                return
+            self._seen.add(task)
+            heapq.heappush(self._queue, (priority, next(self._sequence), task))
+            self._counters["tasks_queued"] += 1
+            self._cond.notify()
+
+    def _throttle(self):
+        with self._rate_lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.min_start_interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def run_pass(self):
+        """Runs one full warming pass, resuming an interrupted one if the state file allows it"""
+        now = time.time()
+        state = self._load_state(now)
+        with self._cond:
+            self._queue = []
+            self._seen = set()
+            self._pass_started_at = state["pass_started_at"] if state else now
+            self._done = {tuple(task) for task in state["done"]} if state else set()
+            self._budget = self.max_tasks
+        if self.priority == "recent":
+            for args in self.source.recent_timetables():
+                self._push(PRIORITY_RECENT, ("timetable",) + tuple(args))
+        self._push(PRIORITY_SCHOOLS, ("schools",))
+
+        workers = [threading.Thread(target=self._work, name="cache-warmer-{}".format(i), daemon=True)
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        with self._cond:
+            self._counters["passes_completed"] += 1
+            self._last_pass_completed_at = time.time()
+        self._save_state(completed=True)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._active:
+                    self._cond.wait()
+                if not self._queue:
+                    self._cond.notify_all()
+                    return
+                _, _, task = heapq.heappop(self._queue)
+                self._active += 1
+            try:
+                self._run_task(task)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    def _run_task(self, task):
+        kind, args = task[0], task[1:]
+        if kind == "timetable" and task in self._done:
+            with self._cond:
+                self._counters["tasks_skipped"] += 1
+            return
+        with self._cond:
+            if self._budget is not None:
+                if self._budget <= 0:
+                    # Dropped without loading anything, so the rest of the queue drains without new tasks.
+                    self._counters["tasks_over_budget"] += 1
+                    return
+                self._budget -= 1
+        self._throttle()
+        try:
+            if kind == "schools":
+                for school_index in range(len(self.source.load_schools())):
+                    self._push(PRIORITY_COURSES, ("courses", school_index))
+            elif kind == "courses":
+                school_index, = args
+                course_list = self.source.load_course_list(school_index)
+                for course_index, course in enumerate(course_list):
+                    course_code = get_course_code(course_list, course_index)
+                    for year in range(1, course_year_count(course) + 1):
+                        self._push(PRIORITY_CURRICULA, ("curricula", school_index, course_code, year))
+            elif kind == "curricula":
+                curricula = self.source.load_curricula(*args)
+                for curr_index in range(len(curricula)):
+                    curr_code = get_curr_code(curricula, curr_index)
+                    self._push(PRIORITY_TIMETABLE, ("timetable",) + tuple(args) + (curr_code,))
+            elif kind == "timetable":
+                self.source.load_timetable_bundle(*args)
+        except Exception as exc:  # noqa: BLE001 - one broken course must not stop the pass
+            with self._cond:
+                self._counters["tasks_failed"] += 1
+            logger.warning("Cache warmer task %s failed: %s", task, exc)
+            return
+
+        save_state = False
+        with self._cond:
+            self._counters["tasks_done"] += 1
+            if kind == "timetable":
+                self._done.add(task)
+                self._counters["timetables_warmed"] += 1
+                save_state = self._counters["timetables_warmed"] % STATE_SAVE_EVERY == 0
+        if save_state:
+            self._save_state()
+
+    def run_forever(self):
+        """Runs a warming pass every interval seconds"""
+        while True:
+            started = time.time()
+            try:
+                self.run_pass()
+            except Exception:  # noqa: BLE001 - keep warming on the next interval
+                logger.exception("Cache warmer pass failed")
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+
+    def start(self):
+        """Starts warming in a daemon thread"""
+        thread = threading.Thread(target=self.run_forever, name="cache-warmer", daemon=True)
+        thread.start()
+        return thread
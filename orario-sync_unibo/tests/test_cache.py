@@ -0,0 +1,156 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from api.cache import MemoryCache, SingleFlight, SqliteCache, TieredCache
+
+
+def events_key(class_name):
+    # Shaped like the events block keys of scripts/local_api_server.py.
+    return ("events", "https://corsi.unibo.it/laurea/x", 1, "000-000", class_name, "0" * 64,
+            "2024-09-01T10:00:00+00:00")
+
+
+class SqliteCacheEvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = SqliteCache(os.path.join(self.directory.name, "cache.sqlite3"), max_bytes=4096)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_evicts_events_blocks_past_max_bytes(self):
+        for i in range(10):
+            self.cache.put(events_key("class {}".format(i)), b"x" * 1000, 60)
+
+        stats = self.cache.stats()
+        self.assertLessEqual(stats["bytes"], 4096)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertEqual(stats["families"]["events"]["evictions"], stats["evictions"])
+        self.assertIsNotNone(self.cache.get(events_key("class 9")))
+        self.assertIsNone(self.cache.get(events_key("class 0")))
+
+    def test_evicts_keys_that_repr_cannot_round_trip(self):
+        version = datetime.datetime(2024, 9, 1, 10, tzinfo=datetime.timezone.utc)
+        for i in range(10):
+            self.cache.put(events_key("class {}".format(i))[:-1] + (version,), b"x" * 1000, 60)
+
+        self.assertEqual(self.cache.stats()["families"]["events"]["evictions"], self.cache.stats()["evictions"])
+
+    def test_failed_put_rolls_back(self):
+        self.cache.put(events_key("kept"), b"x", 60)
+        with mock.patch.object(SqliteCache, "_evict", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.cache.put(events_key("failed"), b"x", 60)
+
+        self.assertFalse(self.cache._connection().in_transaction)
+        self.assertIsNone(self.cache.get(events_key("failed")))
+        self.assertIsNotNone(self.cache.get(events_key("kept")))
+        self.assertEqual(self.cache.stats()["bytes"], self.cache._stored_bytes(self.cache._connection()))
+
+    def test_byte_total_follows_replacements_expiry_and_reopening(self):
+        self.cache.put(events_key("replaced"), b"x" * 1000, 60)
+        self.cache.put(events_key("replaced"), b"x" * 10, 60)
+        self.cache.put(events_key("expired"), b"x" * 100, -1)
+        self.cache.sweep()
+        stored_bytes = self.cache._stored_bytes(self.cache._connection())
+
+        self.assertEqual(self.cache.stats()["bytes"], stored_bytes)
+        reopened = SqliteCache(self.cache.path, max_bytes=4096)
+        self.assertEqual(reopened.stats()["bytes"], stored_bytes)
+
+
+class TieredCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite3")
+        self.cache = self.create_cache()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_cache(self):
+        return TieredCache(MemoryCache(), SqliteCache(self.path), persist=lambda key: key[0] == "timetable")
+
+    def test_only_persists_accepted_keys(self):
+        self.cache.put(("timetable", "course"), "timetable", 60)
+        self.cache.put(("events", "course"), b"events", 60)
+
+        restarted = self.create_cache()
+        self.assertEqual(restarted.get(("timetable", "course")), "timetable")
+        self.assertIsNone(restarted.get(("events", "course")))
+        self.assertEqual(restarted.stats()["persistent"]["entries"], 1)
+        self.assertNotIn("events", restarted.stats()["persistent"]["families"])
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_callers(self, flight, key, loader, count):
+        """Calls flight.do(key, loader) from count threads at once, returning their results or exceptions"""
+        outcomes = [None] * count
+
+        def call(index):
+            try:
+                outcomes[index] = flight.do(key, loader)
+            except Exception as exc:  # noqa: BLE001 - collected for the assertions
+                outcomes[index] = exc
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, outcomes
+
+    def test_concurrent_callers_share_one_load(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            release.wait(5)
+            return object()
+
+        threads, outcomes = self.run_callers(flight, "timetable", loader, 8)
+        # Gives every caller time to join the in-flight load.
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(outcome is outcomes[0] for outcome in outcomes))
+        # The key is released once the load is done, so a later call loads again.
+        self.assertEqual(flight.do("timetable", lambda: "reloaded"), "reloaded")
+
+    def test_waiters_get_the_loader_exception(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def loader():
+            release.wait(5)
+            raise RuntimeError("UniBo is down")
+
+        threads, outcomes = self.run_callers(flight, "timetable", loader, 4)
+        # Gives every caller time to join the in-flight load.
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertTrue(all(isinstance(outcome, RuntimeError) for outcome in outcomes))
+        self.assertEqual(flight.do("timetable", lambda: "recovered"), "recovered")
+
+    def test_different_keys_load_independently(self):
+        flight = SingleFlight()
+        self.assertEqual([flight.do(key, lambda key=key: key) for key in ("courses", "curricula")],
+                         ["courses", "curricula"])
+
+
+if __name__ == "__main__":
+    unittest.main()
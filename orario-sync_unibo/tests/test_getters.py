@@ -0,0 +1,78 @@
+import datetime
+import random
+import unittest
+
+from api import constant, getters
+from api.timetable import Timetable
+
+ITALIAN_MONTHS = ["gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", "luglio", "agosto", "settembre",
+                  "ottobre", "novembre", "dicembre"]
+ITALIAN_DAYS = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
+
+
+def expand_day_by_day(raw_timetable):
+    """The day-by-day expansion encode_no_json_timetable() used before it jumped straight to each weekday"""
+    lessons = Timetable()
+    for _class in raw_timetable:
+        title = _class[constant.NAMEFLD]
+        location = _class[constant.LOCATIONFLD]
+        class_first_lesson = getters.parse_italian_date(_class[constant.LSNSTARTFLD])
+        class_last_lesson = getters.parse_italian_date(_class[constant.LSNENDFLD])
+        for period_date in getters.date_range(class_first_lesson, class_last_lesson):
+            weekday = period_date.weekday()
+            for lesson in _class[constant.LESSONSFLD]:
+                teacher = lesson[constant.TEACHERFLD]
+                starthr = int(lesson[constant.LSNSTARTFLD].split(":")[0])
+                startmm = int(lesson[constant.LSNSTARTFLD].split(":")[1])
+                endhr = int(lesson[constant.LSNENDFLD].split(":")[0])
+                endmm = int(lesson[constant.LSNENDFLD].split(":")[1])
+                if weekday == getters.get_it_dow_number(lesson):
+                    startdatetime = period_date.replace(hour=starthr, minute=startmm)
+                    enddatetime = period_date.replace(hour=endhr, minute=endmm)
+                    lessons.append(title, startdatetime, enddatetime, location, teacher)
+    return lessons
+
+
+def format_italian_date(date):
+    return "{} {} {}".format(date.day, ITALIAN_MONTHS[date.month - 1], date.year)
+
+
+def random_class(rng, index):
+    first_lesson = datetime.date(2024, 9, 1) + datetime.timedelta(rng.randrange(120))
+    # Includes classes whose period is empty or ends before it starts.
+    last_lesson = first_lesson + datetime.timedelta(rng.randrange(-3, 130))
+    lessons = []
+    for _ in range(rng.randrange(5)):
+        start = rng.randrange(8, 19)
+        lessons.append({
+            constant.DOWFLD: rng.choice(ITALIAN_DAYS),
+            constant.LSNSTARTFLD: "{:02d}:{:02d}".format(start, rng.choice((0, 15, 30))),
+            constant.LSNENDFLD: "{:02d}:{:02d}".format(start + rng.randrange(1, 4), rng.choice((0, 30))),
+            constant.TEACHERFLD: rng.choice(("Rossi", "Bianchi", "")),
+        })
+    return {
+        constant.NAMEFLD: "Corso {}".format(index),
+        constant.LOCATIONFLD: rng.choice(("Aula 1", "Aula 2", "")),
+        constant.LSNSTARTFLD: format_italian_date(first_lesson),
+        constant.LSNENDFLD: format_italian_date(last_lesson),
+        constant.LESSONSFLD: lessons,
+    }
+
+
+class EncodeNoJsonTimetableTest(unittest.TestCase):
+
+    def test_matches_the_day_by_day_expansion(self):
+        rng = random.Random(13)
+        for case in range(2000):
+            raw_timetable = [random_class(rng, index) for index in range(rng.randrange(1, 4))]
+            with self.subTest(case=case):
+                self.assertEqual([dict(lesson) for lesson in getters.encode_no_json_timetable(raw_timetable)],
+                                 [dict(lesson) for lesson in expand_day_by_day(raw_timetable)])
+
+    def test_unknown_day_of_week_is_rejected(self):
+        with self.assertRaises(ValueError):
+            getters.get_it_dow_number({constant.DOWFLD: "Lunedi"})
+
+
+if __name__ == "__main__":
+    unittest.main()
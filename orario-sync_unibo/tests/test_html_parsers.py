@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+from api import getters
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "scripts"))
+from compare_html_parsers import PAGE_PARSERS, load_page  # noqa: E402 - lives next to the local API server
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "html_corpus")
+
+
+class HtmlParsersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.default_parser = getters.HTML_PARSER
+
+    def tearDown(self):
+        getters.HTML_PARSER = self.default_parser
+
+    def parse_with(self, parser_name, parse, response):
+        getters.HTML_PARSER = parser_name
+        return parse(response)
+
+    @unittest.skipIf(getters.lxml is None, "lxml is not installed")
+    def test_tree_builders_extract_the_same_data(self):
+        pages = sorted(name for name in os.listdir(CORPUS_DIR) if name.endswith(".html"))
+        self.assertTrue(pages)
+        for file_name in pages:
+            parse = PAGE_PARSERS[file_name.split("__", 1)[0]]
+            response = load_page(os.path.join(CORPUS_DIR, file_name))
+            with self.subTest(page=file_name):
+                expected = self.parse_with("html5lib", parse, response)
+                self.assertTrue(expected)
+                self.assertEqual(self.parse_with("lxml", parse, response), expected)
+
+    def test_legacy_lessons_without_tbody(self):
+        response = load_page(os.path.join(CORPUS_DIR, "timetable_no_json__no_tbody.html"))
+        for parser_name in getters.HTML_PARSERS if getters.lxml is not None else ("html5lib",):
+            with self.subTest(parser=parser_name):
+                raw_timetable, classes = self.parse_with(parser_name, getters.parse_timetable_no_json, response)
+                self.assertEqual(len(classes), 3)
+                self.assertEqual([len(_class[getters.constant.LESSONSFLD]) for _class in raw_timetable], [2, 1, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,310 @@
+import asyncio
+import datetime
+import http.client
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "scripts"))
+try:
+    import local_api_server  # noqa: E402 - the local server is a script, not part of the api package
+except ImportError as exc:
+    raise unittest.SkipTest("the local API server cannot be imported: {}".format(exc))
+
+from api import constant  # noqa: E402
+from api.cache import MemoryCache, SingleFlight  # noqa: E402
+from api.getters import UpstreamDataError  # noqa: E402
+from api.timetable import Timetable  # noqa: E402
+
+
+def http_get(port, path, read=True):
+    """Sends a GET request and returns the connected socket, or the raw response if read is set"""
+    client = socket.create_connection(("127.0.0.1", port), timeout=10)
+    client.sendall("GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".format(path).encode("ascii"))
+    if not read:
+        return client
+    response = b""
+    with client:
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return response
+            response += data
+
+
+class StubHandler(local_api_server.BufferedApiHandler):
+    release = threading.Event()
+
+    def do_GET(self):
+        if self.path == "/large":
+            body = b"x" * (32 * 1024 * 1024)
+        else:
+            if self.path == "/block":
+                self.release.wait(10)
+            body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), 1024 * 1024):
+            self.wfile.write(body[start:start + 1024 * 1024])
+
+
+class AsyncApiServerTest(unittest.TestCase):
+
+    def start_server(self, **kwargs):
+        server = local_api_server.AsyncApiServer(handler_cls=StubHandler, **kwargs)
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(asyncio.start_server(server._serve_connection, "127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(5)
+            listener.close()
+
+        self.addCleanup(stop)
+        return server, listener.sockets[0].getsockname()[1]
+
+    def test_rejects_requests_beyond_max_pending_with_503(self):
+        StubHandler.release.clear()
+        self.addCleanup(StubHandler.release.set)
+        server, port = self.start_server(workers=1, max_pending=1)
+        blocked = http_get(port, "/block", read=False)
+        self.addCleanup(blocked.close)
+        while server.stats()["pending"] < 1:
+            time.sleep(0.01)
+
+        response = http_get(port, "/")
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+        self.assertIn(b"Retry-After: 1\r\n", response)
+        self.assertEqual(server.stats()["rejected"], 1)
+
+        StubHandler.release.set()
+        while server.stats()["pending"]:
+            time.sleep(0.01)
+        self.assertTrue(http_get(port, "/").startswith(b"HTTP/1.1 200 "))
+
+    def test_clients_that_stop_reading_do_not_hold_workers(self):
+        with mock.patch.object(local_api_server, "KEEPALIVE_TIMEOUT_SECONDS", 0.5):
+            server, port = self.start_server(workers=2, max_pending=2)
+            stalled = [http_get(port, "/large", read=False) for _ in range(2)]
+            for client in stalled:
+                self.addCleanup(client.close)
+            while server.stats()["pending"] < 2:
+                time.sleep(0.01)
+
+            deadline = time.monotonic() + 5
+            while server.stats()["pending"] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(server.stats()["pending"], 0)
+            self.assertTrue(http_get(port, "/").startswith(b"HTTP/1.1 200 "))
+
+
+class CachedCallTest(unittest.TestCase):
+    KEY = ("feed", "https://corsi.unibo.it/laurea/x", 1, "000-000", 3)
+
+    def setUp(self):
+        class Handler(local_api_server.LocalApiHandler):
+            _cache = MemoryCache()
+            _inflight = SingleFlight()
+            _refreshing = set()
+
+        self.handler_cls = Handler
+        self.loads = []
+
+    def put_stale(self, value):
+        self.handler_cls._cache.put(self.KEY, value, 0, stale_ttl=60)
+
+    def loader(self, value, release=None):
+        def load():
+            self.loads.append(value)
+            if release is not None:
+                release.wait(5)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        return load
+
+    def wait_for_refreshes(self):
+        deadline = time.monotonic() + 5
+        while self.handler_cls._refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.handler_cls._refreshing)
+
+    def cached_value(self):
+        return self.handler_cls._cache.peek(self.KEY)[0]
+
+    def test_stale_values_are_served_while_one_background_refresh_runs(self):
+        self.put_stale("old")
+        release = threading.Event()
+
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("new", release)), "old")
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("newer", release)), "old")
+        release.set()
+        self.wait_for_refreshes()
+
+        self.assertEqual(self.loads, ["new"])
+        self.assertEqual(self.cached_value(), "new")
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("newer")), "new")
+        self.assertEqual(self.loads, ["new"])
+
+    def test_failed_background_refresh_keeps_the_stale_value(self):
+        self.put_stale("old")
+
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader(UpstreamDataError("down"))), "old")
+        self.wait_for_refreshes()
+
+        self.assertEqual(self.cached_value(), "old")
+        self.assertEqual(self.handler_cls._cache.peek(self.KEY)[1], True)
+
+    def test_warmer_threads_refresh_stale_values_synchronously(self):
+        self.put_stale("old")
+        self.handler_cls._sync_refresh.enabled = True
+        self.addCleanup(setattr, self.handler_cls._sync_refresh, "enabled", False)
+
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("new")), "new")
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader(UpstreamDataError("down"))), "new")
+        self.put_stale("new")
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader(UpstreamDataError("down"))), "new")
+        self.assertFalse(self.handler_cls._refreshing)
+
+    def test_misses_load_once_and_failures_are_not_cached(self):
+        with self.assertRaises(UpstreamDataError):
+            self.handler_cls._cached_call(self.KEY, self.loader(UpstreamDataError("down")))
+        self.assertIsNone(self.handler_cls._cache.peek(self.KEY))
+
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("new")), "new")
+        self.assertEqual(self.handler_cls._cached_call(self.KEY, self.loader("newer")), "new")
+        self.assertEqual(self.loads[1:], ["new"])
+
+
+class FakeCatalog:
+    """UniBo's catalog for the routes: one school, whose courses each have one curriculum and two classes"""
+
+    def __init__(self):
+        self.courses = [("8000", "Ingegneria Informatica [L]", "https://corsi.unibo.it/laurea/IngegneriaInformatica"),
+                        ("8001", "Fisica [L]", "https://corsi.unibo.it/laurea/Fisica")]
+        self.timetable_requests = []
+
+    def get_department_names(self):
+        return ["Ingegneria e Architettura"]
+
+    def get_course_list(self, school_id):
+        return [{constant.CODEFLD: code, constant.NAMEFLD: name, constant.LINKFLD: link}
+                for code, name, link in self.courses]
+
+    def get_curricula(self, course_url, year):
+        return [{constant.CODEFLD: "000-000", "label": "Curriculum comune"}]
+
+    def get_timetable_bundle(self, course_url, year, curr_code):
+        self.timetable_requests.append((course_url, year, curr_code))
+        timetable = Timetable()
+        course_name = course_url.rsplit("/", 1)[1]
+        for day, class_name in ((7, "Analisi"), (8, "Algebra")):
+            start = datetime.datetime(2024, 10, day, 9)
+            timetable.append("{} {}".format(class_name, course_name), start, start + datetime.timedelta(hours=2),
+                             "Aula 1", "Rossi")
+        timetable.version = datetime.datetime(2024, 9, 1, tzinfo=datetime.timezone.utc)
+        return timetable, ["Analisi {}".format(course_name), "Algebra {}".format(course_name)]
+
+
+class ApiRoutesTest(unittest.TestCase):
+    GETICAL = "/api/getical?school=0&course=0&year=1&curr=0&classes=3"
+    FEED = "/api/feed/0/8000/1/000-000/3.ics"
+
+    def setUp(self):
+        class Handler(local_api_server.LocalApiHandler):
+            _cache = MemoryCache()
+            _inflight = SingleFlight()
+            _refreshing = set()
+            _recent_timetables = local_api_server.OrderedDict()
+            _rate_buckets = local_api_server.defaultdict(local_api_server.deque)
+
+            def log_message(self, *args):
+                pass
+
+        self.catalog = FakeCatalog()
+        for name in ("get_department_names", "get_course_list", "get_curricula", "get_timetable_bundle"):
+            patcher = mock.patch.object(local_api_server, name, getattr(self.catalog, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.handler_cls = Handler
+        server = local_api_server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.port = server.server_address[1]
+
+    def request(self, path, headers=None):
+        """Sends a GET request and returns the (status, headers, body) tuple of the response"""
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def test_cacheable_routes_answer_304_to_their_current_etag(self):
+        paths = ["/api/getschools", "/api/getcourses?school=0", "/api/getcurricula?school=0&course=0&year=1",
+                 "/api/getclasses?school=0&course=0&year=1&curr=0", self.GETICAL, self.FEED]
+        for path in paths:
+            with self.subTest(path=path):
+                status, headers, body = self.request(path)
+                etag = headers["ETag"]
+                self.assertEqual(status, 200)
+                self.assertTrue(body)
+
+                for if_none_match in (etag, "W/" + etag, '"stale", ' + etag):
+                    status, headers, body = self.request(path, {"If-None-Match": if_none_match})
+                    self.assertEqual((status, body), (304, b""))
+                    self.assertEqual(headers["ETag"], etag)
+                status, headers, body = self.request(path, {"If-None-Match": '"stale"'})
+                self.assertEqual(status, 200)
+                self.assertTrue(body)
+
+    def test_calendar_etags_follow_the_selected_classes(self):
+        _, getical_headers, getical_body = self.request(self.GETICAL)
+        _, feed_headers, feed_body = self.request(self.FEED)
+        _, other_headers, _ = self.request(self.GETICAL.replace("classes=3", "classes=1"))
+
+        # The download and the feed of the same selection are the same file.
+        self.assertEqual(getical_headers["ETag"], feed_headers["ETag"])
+        self.assertEqual(getical_body, feed_body)
+        self.assertNotEqual(other_headers["ETag"], getical_headers["ETag"])
+        self.assertIn(b"BEGIN:VEVENT", feed_body)
+        self.assertEqual(self.catalog.timetable_requests, [(self.catalog.courses[0][2], 1, "000-000")])
+
+    def test_feeds_follow_their_course_when_the_catalog_is_reordered(self):
+        feed = "/api/feed/0/8001/1/000-000/3.ics"
+        status, _, body = self.request(feed)
+        self.assertEqual(status, 200)
+        self.assertIn(b"Fisica", body)
+
+        self.catalog.courses.reverse()
+        self.handler_cls._cache = MemoryCache()
+        status, _, reordered_body = self.request(feed)
+
+        self.assertEqual((status, reordered_body), (200, body))
+        self.assertEqual([request[0] for request in self.catalog.timetable_requests],
+                         ["https://corsi.unibo.it/laurea/Fisica"] * 2)
+
+    def test_feeds_of_unlisted_codes_are_rejected(self):
+        for path in ("/api/feed/0/8999/1/000-000/3.ics", "/api/feed/0/8000/1/999-000/3.ics"):
+            with self.subTest(path=path):
+                status, _, _ = self.request(path)
+                self.assertEqual(status, 400)
+        # Positions are not codes: course 1 is not a code in the catalog.
+        self.assertEqual(self.request("/api/feed/0/1/1/000-000/3.ics")[0], 400)
+        self.assertEqual(self.request("/api/feed/0/8000/1/000-000/3")[0], 404)
+        self.assertEqual(self.catalog.timetable_requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import datetime
+import unittest
+
+from api.timetable import Timetable
+
+UTC = datetime.timezone.utc
+
+
+def make_timetable(*days, version=None):
+    timetable = Timetable()
+    for day in days:
+        start = datetime.datetime(2024, 10, day, 9)
+        timetable.append("Analisi", start, start + datetime.timedelta(hours=2), "Aula 1", "Rossi")
+    timetable.version = version
+    return timetable
+
+
+class KeepVersionOfTest(unittest.TestCase):
+
+    def test_unchanged_lessons_keep_the_previous_version(self):
+        previous = make_timetable(7, 8, version=datetime.datetime(2024, 9, 1, tzinfo=UTC))
+        current = make_timetable(7, 8, version=datetime.datetime(2024, 9, 2, tzinfo=UTC))
+
+        current.keep_version_of(previous)
+        self.assertEqual(current.version, previous.version)
+
+    def test_changed_lessons_never_get_an_earlier_version(self):
+        # An earlier lesson was added, and the new download is dated before the previous one.
+        previous = make_timetable(7, 8, version=datetime.datetime(2024, 9, 2, tzinfo=UTC))
+        current = make_timetable(1, 7, 8, version=datetime.datetime(2024, 9, 1, tzinfo=UTC))
+
+        current.keep_version_of(previous)
+        self.assertGreater(current.version, previous.version)
+
+    def test_changed_lessons_keep_a_later_version(self):
+        previous = make_timetable(7, version=datetime.datetime(2024, 9, 1, tzinfo=UTC))
+        later = datetime.datetime(2024, 9, 3, tzinfo=UTC)
+        current = make_timetable(8, version=later)
+
+        current.keep_version_of(previous)
+        self.assertEqual(current.version, later)
+        current.keep_version_of(None)
+        self.assertEqual(current.version, later)
+
+
+if __name__ == "__main__":
+    unittest.main()
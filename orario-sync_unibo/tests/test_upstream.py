@@ -0,0 +1,210 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from api import upstream
+from api.cache import MemoryCache
+
+
+def make_response(status_code, body=b"", etag=None):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = body
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
+
+class FakeUpstream:
+    """Answers GETs with one page at version etag, and 304 to requests that already have it"""
+
+    def __init__(self, etag='"v1"'):
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(headers)
+        if headers.get("If-None-Match") == self.etag:
+            return make_response(304)
+        return make_response(200, self.etag.encode("ascii"), etag=self.etag)
+
+
+def parse_page(response):
+    return response.content.decode("ascii")
+
+
+class ResponseStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemoryCache()
+        self.store = upstream.ResponseStore(self.cache)
+        self.upstream = FakeUpstream()
+        patcher = mock.patch.object(upstream, "get", self.upstream.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, url="https://corsi.unibo.it/page"):
+        return self.store.parse(url, self.store.get(url, parse_page), parse_page)
+
+    def test_revalidated_pages_reuse_the_parsed_result(self):
+        self.assertEqual(self.fetch(), '"v1"')
+        self.assertEqual(self.fetch(), '"v1"')
+
+        self.assertEqual(self.upstream.requests[1].get("If-None-Match"), '"v1"')
+        self.assertEqual(self.store.stats()["revalidated"], 1)
+        self.upstream.etag = '"v2"'
+        self.assertEqual(self.fetch(), '"v2"')
+        self.assertEqual(self.store.stats()["modified"], 1)
+
+    def test_keeps_validators_and_result_in_the_cache_budget_but_no_response(self):
+        self.fetch()
+
+        (validators, result), _ = self.cache.peek(("upstream", "https://corsi.unibo.it/page", parse_page))
+        self.assertEqual(validators["ETag"], '"v1"')
+        self.assertEqual(result, '"v1"')
+        self.assertEqual(self.cache.stats()["entries"], 1)
+        self.assertGreater(self.cache.stats()["bytes"], 0)
+
+    def test_304_after_eviction_is_retried_unconditionally(self):
+        self.fetch()
+        real_get = self.upstream.get
+
+        def evict_then_get(url, headers=None, **kwargs):
+            # Concurrent traffic evicts the entry while the conditional request is in flight.
+            self.cache._entries.clear()
+            return real_get(url, headers=headers, **kwargs)
+
+        with mock.patch.object(upstream, "get", evict_then_get):
+            self.assertEqual(self.fetch(), '"v1"')
+
+        self.assertEqual(self.upstream.requests[-2].get("If-None-Match"), '"v1"')
+        self.assertNotIn("If-None-Match", self.upstream.requests[-1])
+        self.assertEqual(self.store.stats()["lost"], 1)
+
+
+class HostLimiterTest(unittest.TestCase):
+
+    def wait_for_queue_depth(self, limiter, depth):
+        deadline = time.monotonic() + 5
+        while limiter.stats()["queue_depth"] < depth and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(limiter.stats()["queue_depth"], depth)
+
+    def test_interactive_requests_get_freed_slots_before_background_ones(self):
+        limiter = upstream.HostLimiter(max_in_flight=1, timeout=10)
+        limiter.acquire()
+        granted = []
+
+        def request(name, priority):
+            limiter.acquire(priority)
+            granted.append(name)
+            limiter.release()
+
+        threads = []
+        for depth, (name, priority) in enumerate([("background", upstream.PRIORITY_BACKGROUND),
+                                                  ("first interactive", upstream.PRIORITY_INTERACTIVE),
+                                                  ("second interactive", upstream.PRIORITY_INTERACTIVE)], 1):
+            thread = threading.Thread(target=request, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            self.wait_for_queue_depth(limiter, depth)
+        limiter.release()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(granted, ["first interactive", "second interactive", "background"])
+        self.assertEqual(limiter.stats()["in_flight"], 0)
+        self.assertEqual(limiter.stats()["max_queue_depth"], 3)
+
+    def test_waiters_give_up_after_the_queue_timeout(self):
+        limiter = upstream.HostLimiter(max_in_flight=1, timeout=0.05)
+        limiter.acquire()
+
+        with self.assertRaises(upstream.UpstreamQueueTimeout):
+            limiter.acquire()
+        stats = limiter.stats()
+        self.assertEqual((stats["timeouts"], stats["queue_depth"], stats["in_flight"]), (1, 0, 1))
+
+        # The timed-out waiter must not be granted the slot once it frees up.
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(limiter.stats()["in_flight"], 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(upstream.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = upstream.CircuitBreaker("corsi.unibo.it", window=4, min_calls=4, failure_ratio=0.5,
+                                               slow_call_seconds=5, open_seconds=30)
+
+    def record_calls(self, *outcomes):
+        for failed in outcomes:
+            self.breaker.allow()
+            self.breaker.record(failed, 0.1)
+
+    def open_circuit(self):
+        self.record_calls(False, True, False, True)
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_OPEN)
+
+    def test_opens_once_the_failure_ratio_is_reached_over_enough_calls(self):
+        self.record_calls(True, True, True)
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_CLOSED)
+        self.breaker.allow()
+        # Slow calls count as failures.
+        self.breaker.record(False, 6)
+
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_OPEN)
+        with self.assertRaises(upstream.CircuitOpenError):
+            self.breaker.allow()
+        self.assertEqual(self.breaker.stats()["circuit_rejected"], 1)
+
+    def test_lets_a_single_probe_through_once_open_seconds_have_passed(self):
+        self.open_circuit()
+        self.now += 30
+
+        self.breaker.allow()
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_HALF_OPEN)
+        with self.assertRaises(upstream.CircuitOpenError):
+            self.breaker.allow()
+        self.breaker.record(False, 0.1)
+
+        stats = self.breaker.stats()
+        self.assertEqual(stats["circuit_state"], upstream.CIRCUIT_CLOSED)
+        self.assertEqual((stats["circuit_opened"], stats["circuit_half_opened"], stats["circuit_closed"]), (1, 1, 1))
+        self.assertEqual(stats["circuit_failure_ratio"], 0.0)
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.allow()
+        self.breaker.record(True, 0.1)
+
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_OPEN)
+        self.now += 29
+        with self.assertRaises(upstream.CircuitOpenError):
+            self.breaker.allow()
+        self.now += 1
+        self.breaker.allow()
+        self.assertEqual(self.breaker.stats()["circuit_half_opened"], 2)
+
+    def test_cancelled_probe_frees_the_probe_slot(self):
+        self.open_circuit()
+        self.now += 30
+        self.breaker.allow()
+        # The probe timed out in the HostLimiter queue and was never sent.
+        self.breaker.cancel()
+
+        self.breaker.allow()
+        self.assertEqual(self.breaker.stats()["circuit_state"], upstream.CIRCUIT_HALF_OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()
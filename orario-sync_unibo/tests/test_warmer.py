@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from api import constant
+from api.warmer import CacheWarmer
+
+
+class FakeCatalog:
+    """One school whose two-year courses each have a single curriculum, in a reorderable catalog"""
+
+    def __init__(self, course_codes):
+        self.course_codes = list(course_codes)
+        self.loaded = []
+
+    def recent_timetables(self):
+        return []
+
+    def load_schools(self):
+        return ["Ingegneria"]
+
+    def load_course_list(self, school_index):
+        return [{constant.CODEFLD: code, constant.NAMEFLD: "Corso {} [LM]".format(code)} for code in self.course_codes]
+
+    def load_curricula(self, school_index, course_code, year):
+        return [{constant.CODEFLD: "000-000"}]
+
+    def load_timetable_bundle(self, school_index, course_code, year, curr_code):
+        self.loaded.append((school_index, course_code, year, curr_code))
+
+
+def make_warmer(source, **kwargs):
+    return CacheWarmer(source, concurrency=1, rate_per_second=0, priority="catalog", **kwargs)
+
+
+class CacheWarmerTest(unittest.TestCase):
+
+    def test_resumed_pass_skips_warmed_timetables_by_code(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "warmer.json")
+            with open(state_path, "w", encoding="utf-8") as state_file:
+                # An interrupted pass warmed both years of course 8001, which UniBo then moved to the front.
+                json.dump({"pass_started_at": time.time(), "completed_at": None,
+                           "done": [["timetable", 0, "8001", 1, "000-000"], ["timetable", 0, "8001", 2, "000-000"]]},
+                          state_file)
+            source = FakeCatalog(["8001", "8000"])
+
+            make_warmer(source, state_path=state_path).run_pass()
+
+        self.assertEqual(source.loaded, [(0, "8000", 1, "000-000"), (0, "8000", 2, "000-000")])
+
+    def test_pass_stops_starting_tasks_once_its_budget_is_spent(self):
+        source = FakeCatalog(["8000", "8001", "8002"])
+        warmer = make_warmer(source, max_tasks=4)
+
+        warmer.run_pass()
+        self.assertEqual(warmer.stats()["tasks_done"], 4)
+        self.assertGreater(warmer.stats()["tasks_over_budget"], 0)
+        self.assertEqual(source.loaded, [(0, "8000", 1, "000-000")])
+
+        # The budget is per pass.
+        warmer.run_pass()
+        self.assertEqual(warmer.stats()["tasks_done"], 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks timetable encoding speed and memory on a recorded @@orario_reale_json payload.
+
+Record a payload with --fetch, or pass any file saved from a course's orario_reale_json endpoint."""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import dateutil.parser
+import requests
+
+from api import cache, constant, getters
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_with_dateutil(raw_timetable):
+    for lesson in raw_timetable:
+        dateutil.parser.parse(lesson[constant.START])
+        dateutil.parser.parse(lesson[constant.END])
+
+
+def parse_with_fast_path(raw_timetable):
+    for lesson in raw_timetable:
+        getters.parse_lesson_datetime(lesson[constant.START])
+        getters.parse_lesson_datetime(lesson[constant.END])
+
+
+def allocated_by(func, *args):
+    """Gets the result of func and the bytes it still holds allocated once it returns"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def as_lesson_dicts(timetable):
+    """Rebuilds the per-lesson dicts encode_json_timetable used to return, for comparison"""
+    return [dict(lesson) for lesson in timetable]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("payload", help="recorded orario_reale_json payload")
+    parser.add_argument("--fetch", default="", metavar="COURSE_URL", help="record the payload of this course first")
+    parser.add_argument("--year", default=1, type=int)
+    parser.add_argument("--curr", default="")
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    if args.fetch:
+        normalized = getters.normalize_course_url(args.fetch)
+        url = constant.TIMETABLEURLFORMAT[getters.get_course_lang(normalized)].format(normalized, args.year, args.curr)
+        response = requests.get(url, timeout=getters.REQUEST_TIMEOUT)
+        response.raise_for_status()
+        with open(args.payload, "wb") as payload:
+            payload.write(response.content)
+
+    with open(args.payload, encoding="utf-8") as payload:
+        raw_timetable = json.load(payload)
+    print("{} lessons".format(len(raw_timetable)))
+
+    dateutil_time = best_of(args.repeat, parse_with_dateutil, raw_timetable)
+    fast_time = best_of(args.repeat, parse_with_fast_path, raw_timetable)
+    print("timestamps, dateutil:  {:8.2f} ms".format(dateutil_time * 1000))
+    print("timestamps, fast path: {:8.2f} ms ({:.1f}x)".format(fast_time * 1000, dateutil_time / fast_time))
+    encode_time = best_of(args.repeat, getters.encode_json_timetable, raw_timetable)
+    print("encode_json_timetable: {:8.2f} ms".format(encode_time * 1000))
+
+    timetable, compact_bytes = allocated_by(getters.encode_json_timetable, raw_timetable)
+    _, dicts_bytes = allocated_by(as_lesson_dicts, timetable)
+    print("memory, lesson dicts:  {:8.1f} KiB (cache accounts {:.1f} KiB)".format(
+        dicts_bytes / 1024, cache.approximate_size(as_lesson_dicts(timetable)) / 1024))
+    print("memory, Timetable:     {:8.1f} KiB (cache accounts {:.1f} KiB, {:.1f}x smaller)".format(
+        compact_bytes / 1024, cache.approximate_size(timetable) / 1024, dicts_bytes / compact_bytes))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Checks that every HTML tree builder extracts the same data from saved UniBo pages, and times them.
+
+The corpus is a directory of saved pages named `<kind>__<label>.html`, where kind is one of the keys of
+PAGE_PARSERS. Use --fetch to save the current live pages into it first."""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+from bs4 import BeautifulSoup, FeatureNotFound
+
+from api import constant, getters
+
+PAGE_PARSERS = {
+    "departments": getters.parse_department_names,
+    "legacy_departments": getters.parse_legacy_department_names,
+    "courses": getters.parse_course_list,
+    "legacy_courses": getters.parse_legacy_course_list,
+    "classes_no_json": getters.parse_classes_no_json,
+    "timetable_no_json": getters.parse_timetable_no_json,
+}
+
+
+def available_parsers():
+    parsers = []
+    for name in getters.HTML_PARSERS:
+        try:
+            BeautifulSoup("<p></p>", features=name)
+        except FeatureNotFound:
+            continue
+        parsers.append(name)
+    return parsers
+
+
+def load_page(path):
+    response = requests.models.Response()
+    with open(path, "rb") as page:
+        response._content = page.read()
+    response.status_code = 200
+    response.headers["content-type"] = "text/html; charset=utf-8"
+    response.encoding = "utf-8"
+    return response
+
+
+def fetch_corpus(corpus_dir, school_id, course_url, year, curr):
+    os.makedirs(corpus_dir, exist_ok=True)
+    pages = {
+        "departments__catalog": constant.CATALOGURL,
+        "courses__school{}".format(school_id): constant.CATALOGELENCOURLFORMAT.format(school_id),
+    }
+    if course_url:
+        normalized = getters.normalize_course_url(course_url)
+        url_format = constant.TIMETABLEURLFORMATNOJSON[getters.get_course_lang(normalized)]
+        pages["timetable_no_json__course"] = url_format.format(normalized, year, curr)
+    for name, url in pages.items():
+        response = requests.get(url, timeout=getters.REQUEST_TIMEOUT)
+        response.raise_for_status()
+        with open(os.path.join(corpus_dir, name + ".html"), "wb") as page:
+            page.write(response.content)
+        print("saved {} ({} bytes)".format(name, len(response.content)))
+
+
+def run_parser(parser_name, parse, response, repeat):
+    getters.HTML_PARSER = parser_name
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = parse(response)
+    return result, (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="directory with saved <kind>__<label>.html pages")
+    parser.add_argument("--repeat", default=5, type=int, help="parses per page and tree builder when timing")
+    parser.add_argument("--fetch", action="store_true", help="save live UniBo pages into the corpus first")
+    parser.add_argument("--school", default=1, type=int, help="catalog school id to fetch (with --fetch)")
+    parser.add_argument("--course-url", default="", help="legacy-timetable course to fetch (with --fetch)")
+    parser.add_argument("--year", default=1, type=int)
+    parser.add_argument("--curr", default="")
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_corpus(args.corpus, args.school, args.course_url, args.year, args.curr)
+
+    parsers = available_parsers()
+    print("tree builders: {}".format(", ".join(parsers)))
+    mismatches = 0
+    totals = dict.fromkeys(parsers, 0.0)
+    for file_name in sorted(os.listdir(args.corpus)):
+        kind = file_name.split("__", 1)[0]
+        if not file_name.endswith(".html") or kind not in PAGE_PARSERS:
+            continue
+        response = load_page(os.path.join(args.corpus, file_name))
+        results = {}
+        timings = []
+        for parser_name in parsers:
+            try:
+                result, elapsed = run_parser(parser_name, PAGE_PARSERS[kind], response, args.repeat)
+            except Exception as exc:  # noqa: BLE001 - a builder that breaks a parse function is a mismatch too
+                results[parser_name] = "error: {!r}".format(exc)
+                timings.append("{} failed ({})".format(parser_name, type(exc).__name__))
+                continue
+            results[parser_name] = json.dumps(result, default=str, sort_keys=True)
+            totals[parser_name] += elapsed
+            timings.append("{} {:.1f} ms".format(parser_name, elapsed * 1000))
+        identical = len(set(results.values())) == 1
+        mismatches += 0 if identical else 1
+        print("{:<50} {:<9} {}".format(file_name, "identical" if identical else "MISMATCH", ", ".join(timings)))
+
+    if "html5lib" in totals and totals["html5lib"]:
+        for parser_name in parsers:
+            if not totals[parser_name]:
+                continue
+            print("{}: {:.1f} ms total, {:.2f}x html5lib speed".format(
+                parser_name, totals[parser_name] * 1000, totals["html5lib"] / totals[parser_name]))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
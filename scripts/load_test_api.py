@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Load-tests a running backend API server, reporting latency percentiles and the server's memory and threads.
+
+Run it once against the threaded server and once against `local_api_server.py --asyncio`, with the same
+arguments, to compare them. Memory and thread counts are read from /proc, so --pid only works on Linux."""
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+DEFAULT_PATHS = (
+    "/api/getschools",
+    "/api/getcourses?school=0",
+    "/api/getcurricula?school=0&course=0&year=1",
+    "/api/getclasses?school=0&course=0&year=1&curr=0",
+    "/api/getical?school=0&course=0&year=1&curr=0&classes=1",
+)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def read_proc_status(pid):
+    fields = {}
+    with open("/proc/{}/status".format(pid), encoding="ascii") as status:
+        for line in status:
+            name, _, value = line.partition(":")
+            fields[name] = value.strip()
+    return fields
+
+
+class ProcessSampler:
+    """Samples the resident memory and thread count of a process in a background thread"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kib = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                fields = read_proc_status(self.pid)
+            except OSError:
+                return
+            self.peak_rss_kib = max(self.peak_rss_kib, int(fields.get("VmRSS", "0 kB").split()[0]))
+            self.peak_threads = max(self.peak_threads, int(fields.get("Threads", "0")))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+async def fetch(host, port, path, timeout):
+    """Sends one GET on a fresh connection and returns (status, seconds), with status 0 on failure"""
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        try:
+            writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n".format(path, host).encode("ascii"))
+            response = await asyncio.wait_for(reader.read(), timeout)
+        finally:
+            writer.close()
+        status = int(response.split(b" ", 2)[1])
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        status = 0
+    return status, time.perf_counter() - started
+
+
+async def run_load(base_url, paths, total, concurrency, timeout):
+    parsed = urlparse(base_url)
+    host, port = parsed.hostname, parsed.port or 80
+    limit = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(i):
+        async with limit:
+            results.append(await fetch(host, port, paths[i % len(paths)], timeout))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base_url", help="server root, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--path", action="append", dest="paths", help="request path, repeatable (default: all routes)")
+    parser.add_argument("--requests", default=2000, type=int, help="total requests")
+    parser.add_argument("--concurrency", default=200, type=int, help="requests in flight at once")
+    parser.add_argument("--timeout", default=30.0, type=float, help="seconds before a request counts as failed")
+    parser.add_argument("--pid", type=int, help="server process id, to report its peak memory and thread count")
+    args = parser.parse_args()
+
+    paths = args.paths or list(DEFAULT_PATHS)
+    load = run_load(args.base_url, paths, args.requests, args.concurrency, args.timeout)
+    if args.pid:
+        with ProcessSampler(args.pid) as sampler:
+            results, elapsed = asyncio.run(load)
+    else:
+        sampler = None
+        results, elapsed = asyncio.run(load)
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(seconds for status, seconds in results if status == 200 or status == 304)
+    print("{} requests in {:.2f} s ({:.0f} req/s), concurrency {}".format(
+        len(results), elapsed, len(results) / elapsed, args.concurrency))
+    print("status codes: {}".format(", ".join("{}: {}".format(code or "failed", count)
+                                              for code, count in sorted(statuses.items()))))
+    print("latency of successful requests: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, percentile(latencies, 1.0) * 1000))
+    if sampler is not None:
+        print("server: peak RSS {:.1f} MiB, peak threads {}".format(sampler.peak_rss_kib / 1024, sampler.peak_threads))
+    return 0 if statuses.get(0, 0) == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,19 +2,28 @@
 """Local HTTP server that emulates the backend API routes."""
 
 import argparse
+import asyncio
+import hashlib
+import io
+import ipaddress
 import json
+import logging
 import os
-import sys
+import re
 import threading
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.client import parse_headers
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, urlparse
 
-from api import constant
+from api import constant, metrics, upstream
+from api.cache import SingleFlight, TieredCache, create_cache, start_sweeper
+from api.warmer import WARMER_MEMORY_FRACTION, WARMER_PRIORITIES, WARMER_PRIORITY, CacheWarmer
 from api.getters import (
     UpstreamDataError,
-    get_classes,
+    UpstreamUnavailableError,
     get_course_code,
     get_course_list,
     get_course_name,
@@ -22,9 +31,12 @@ from api.getters import (
     get_curr_code,
     get_curricula,
     get_department_names,
-    get_ical_file,
+    get_event_uid_namespace,
     get_safe_course_name,
-    get_timetable,
+    get_timetable_bundle,
+    iter_ical_file,
+    normalize_course_url,
+    render_class_events,
 )
 from api.security import (
     ClientInputError,
@@ -37,33 +49,194 @@ from api.security import (
 )
 
 CACHE_TTL_SECONDS = int(os.getenv("BACKEND_CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_STALE_SECONDS = int(os.getenv("BACKEND_CACHE_MAX_STALE_SECONDS", "86400"))
+CACHE_REFRESH_WORKERS = int(os.getenv("BACKEND_CACHE_REFRESH_WORKERS", "2"))
+WARMER_RECENT_KEYS = int(os.getenv("BACKEND_WARMER_RECENT_KEYS", "256"))
+RESPONSE_CACHE_CONTROL = os.getenv("BACKEND_CACHE_CONTROL", "public, max-age={}".format(CACHE_TTL_SECONDS))
+KEEPALIVE_TIMEOUT_SECONDS = int(os.getenv("BACKEND_KEEPALIVE_TIMEOUT_SECONDS", "15"))
+ASYNC_WORKERS = int(os.getenv("BACKEND_ASYNC_WORKERS", "16"))
+ASYNC_MAX_PENDING = int(os.getenv("BACKEND_ASYNC_MAX_PENDING", "64"))
+ASYNC_MAX_REQUEST_BYTES = 64 * 1024
 RATE_LIMIT_WINDOW_SECONDS = int(os.getenv("BACKEND_RATE_LIMIT_WINDOW_SECONDS", "60"))
 RATE_LIMIT_MAX_REQUESTS = int(os.getenv("BACKEND_RATE_LIMIT_MAX_REQUESTS", "120"))
+# Feeds stay subscribed for months, so they name the course and curriculum by code rather than by catalog position.
+FEED_PATH = re.compile(r"^/api/feed/(\d+)/(\d+)/(\d+)/([A-Za-z0-9-]+)/(\d+)\.ics$")
+FEED_PATH_ARGS = (constant.ARG_SCHOOL, constant.ARG_YEAR, constant.ARG_CLASSES)
+
+ROUTES = {
+    "/api/getschools": "getschools",
+    "/api/getcourses": "getcourses",
+    "/api/getcurricula": "getcurricula",
+    "/api/getclasses": "getclasses",
+    "/api/getical": "getical",
+    "/api/metrics": "metrics",
+}
+
+HTTP_REQUESTS_IN_FLIGHT = metrics.Gauge("orariosync_http_requests_in_flight", "Requests being handled right now")
+HTTP_REQUEST_SECONDS = metrics.Histogram("orariosync_http_request_seconds",
+                                         "Time to handle a request, including writing the response", ("route",))
+HTTP_RESPONSES = metrics.Counter("orariosync_http_responses_total", "Responses sent, by route and status",
+                                 ("route", "status"))
+RATE_LIMIT_REJECTIONS = metrics.Counter("orariosync_rate_limit_rejections_total",
+                                        "Requests answered with 429 by the per-client rate limiter")
+
+logger = logging.getLogger(__name__)
+
+# Cache key families whose values are also kept serialized, mapped to the part of the value each route returns.
+JSON_PAYLOADS = {
+    "schools": lambda schools: schools,
+    "courses": lambda course_list: course_list,
+    "curricula": lambda curricula: curricula,
+    "timetable": lambda bundle: bundle[1],
+}
+# Cache key families scraped from UniBo, the only ones written to the SQLite tier; JSON representations, events
+# blocks and feeds are rebuilt from them in memory.
+PERSISTENT_FAMILIES = frozenset(JSON_PAYLOADS)
+JSON_REPRESENTATION = "json"
+
+
+def representation_key(key):
+    """Gets the cache key of the serialized JSON payload of a cached value
+
+    It keeps the family of the value's key, so /api/metrics counts route traffic under "courses", "timetable" and
+    so on."""
+    return key + (JSON_REPRESENTATION,)
+
+
+def is_persistent_key(key):
+    return key[0] in PERSISTENT_FAMILIES and key[-1] != JSON_REPRESENTATION
+
+
+def make_etag(*parts):
+    """Gets a strong ETag for a response body, or for the values a response body is deterministically built from"""
+    content = hashlib.sha256()
+    for part in parts:
+        content.update(part if isinstance(part, bytes) else repr(part).encode("utf-8"))
+    return '"{}"'.format(content.hexdigest()[:32])
+
+
+def route_name(path):
+    """Gets the route label of a request path for metrics, so that arbitrary paths do not create new series"""
+    if FEED_PATH.match(path):
+        return "feed"
+    return ROUTES.get(path[:-3] if path.endswith(".py") else path, "other")
+
+
+@metrics.timed(metrics.STAGE_SECONDS, "serialize")
+def json_representation(payload):
+    """Serializes a JSON route payload once, as a (body, etag) tuple"""
+    body = json.dumps(payload).encode("utf-8")
+    return body, make_etag(body)
+
+
+def etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header against an ETag, with the weak comparison RFC 9110 requires for it"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any((candidate[2:] if candidate.startswith("W/") else candidate) == etag for candidate in candidates)
+
+
+class TimetableRef(namedtuple("TimetableRef", ["course_url", "course_code", "year", "curr_code", "course_name"])):
+    """Identifies a timetable by its normalized course URL, course code, year and curriculum code
+
+    Cache keys are built from these rather than from positions in the catalog, which change when UniBo
+    reorders it; the course code only names UIDs and the course name .ics files, since the URL already
+    identifies the course."""
+
+    __slots__ = ()
+
+    def cache_key(self):
+        return self.course_url, self.year, self.curr_code
+
+    def uid_namespace(self):
+        return get_event_uid_namespace(self.course_code, self.year, self.curr_code)
 
 
 class LocalApiHandler(BaseHTTPRequestHandler):
-    _cache = {}
-    _cache_lock = threading.Lock()
+    # HTTP/1.1 for chunked .ics streaming; every other response sends Content-Length to keep connections reusable.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT_SECONDS
+    _cache = create_cache(persist=is_persistent_key)
+    _inflight = SingleFlight()
+    _refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+    _refreshing = set()
+    _refresh_lock = threading.Lock()
+    _sync_refresh = threading.local()
+    _recent_timetables = OrderedDict()
+    _recent_lock = threading.Lock()
     _rate_buckets = defaultdict(deque)
     _rate_lock = threading.Lock()
+    # Extra stats() callables exported by /api/metrics, such as the cache warmer's, registered by main().
+    _stats_sources = {}
 
     @classmethod
-    def _cache_get(cls, key):
-        now = time.time()
-        with cls._cache_lock:
-            entry = cls._cache.get(key)
-            if entry is None:
-                return None
-            expires_at, value = entry
-            if now >= expires_at:
-                cls._cache.pop(key, None)
-                return None
-            return value
+    def _cache_peek(cls, key):
+        # Re-reads of entries the caller has just looked up, which must not count as hits or misses again.
+        entry = cls._cache.peek(key)
+        return entry[0] if entry is not None and not entry[1] else None
 
     @classmethod
     def _cache_put(cls, key, value):
-        with cls._cache_lock:
-            cls._cache[key] = (time.time() + CACHE_TTL_SECONDS, value)
+        cls._cache.put(key, value, CACHE_TTL_SECONDS, stale_ttl=CACHE_MAX_STALE_SECONDS)
+
+    @classmethod
+    def _schedule_refresh(cls, key, loader):
+        with cls._refresh_lock:
+            if key in cls._refreshing:
+                return
+            cls._refreshing.add(key)
+        cls._refresh_executor.submit(cls._refresh, key, loader)
+
+    @classmethod
+    def _refresh(cls, key, loader):
+        try:
+            # Nobody is waiting on a background refresh, so interactive misses get upstream slots first.
+            with upstream.request_priority(upstream.PRIORITY_BACKGROUND):
+                cls._inflight.do(key, lambda: cls._store(key, loader()))
+        except UpstreamDataError:
+            # UniBo is unavailable: keep serving the stale value until it reaches its hard expiry.
+            pass
+        except Exception:  # noqa: BLE001 - background refreshes must not kill the executor
+            logger.exception("Background refresh of %s failed", key)
+        finally:
+            with cls._refresh_lock:
+                cls._refreshing.discard(key)
+
+    @classmethod
+    def _refresh_now(cls, key, loader, stale_value):
+        try:
+            return cls._inflight.do(key, lambda: cls._store(key, loader()))
+        except UpstreamDataError:
+            return stale_value
+
+    @classmethod
+    def _store(cls, key, value):
+        payload = JSON_PAYLOADS.get(key[0])
+        if payload is not None:
+            # Serialized and hashed once here, so conditional and repeated requests skip json.dumps.
+            cls._cache_put(representation_key(key), json_representation(payload(value)))
+        cls._cache_put(key, value)
+        return value
+
+    @classmethod
+    def _cached_representation(cls, key, loader):
+        """Gets the (body, etag) tuple of the JSON payload of a cached value, loading the value if needed"""
+        entry = cls._cache.lookup(representation_key(key))
+        if entry is not None:
+            representation, stale = entry
+            if stale:
+                # The value was cached together with its representation: let it schedule its own refresh.
+                loader()
+            return representation
+        value = loader()
+        representation = cls._cache_peek(representation_key(key))
+        if representation is None:
+            representation = json_representation(JSON_PAYLOADS[key[0]](value))
+            cls._cache_put(representation_key(key), representation)
+        return representation
 
     @classmethod
     def _rate_limit_allows(cls, client_key):
@@ -78,17 +251,182 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             bucket.append(now)
             return True
 
-    def _cached_call(self, key, loader):
-        cached = self._cache_get(key)
+    @classmethod
+    def _cached_call(cls, key, loader):
+        entry = cls._cache.lookup(key)
+        if entry is not None:
+            value, stale = entry
+            if stale and getattr(cls._sync_refresh, "enabled", False):
+                return cls._refresh_now(key, loader, value)
+            if stale:
+                # Serve the previous value right away and let one background refresh replace it.
+                cls._schedule_refresh(key, loader)
+            return value
+        # Concurrent misses on the same key share a single upstream load; failures are not cached.
+        return cls._inflight.do(key, lambda: cls._load_and_cache(key, loader))
+
+    @classmethod
+    def _load_and_cache(cls, key, loader):
+        # Another thread may have filled the entry between our miss and becoming the loader.
+        cached = cls._cache_peek(key)
         if cached is not None:
             return cached
-        value = loader()
-        self._cache_put(key, value)
-        return value
+        return cls._store(key, loader())
+
+    @classmethod
+    def _remember_timetable_request(cls, school_index, ref):
+        args = (school_index, ref.course_code, ref.year, ref.curr_code)
+        with cls._recent_lock:
+            cls._recent_timetables.pop(args, None)
+            cls._recent_timetables[args] = True
+            while len(cls._recent_timetables) > WARMER_RECENT_KEYS:
+                cls._recent_timetables.popitem(last=False)
+
+    @classmethod
+    def recent_timetables(cls):
+        """Gets the (school_index, course_code, year, curr_code) tuples of the timetables asked for most recently"""
+        with cls._recent_lock:
+            return list(reversed(cls._recent_timetables))
+
+    @classmethod
+    def load_schools(cls):
+        return cls._cached_call(("schools",), get_department_names)
+
+    @classmethod
+    def load_course_list(cls, school_index):
+        return cls._cached_call(("courses", school_index), lambda: get_course_list(school_index + 1))
+
+    @classmethod
+    def resolve_course(cls, school_index, course_index):
+        """Gets the normalized URL, the code and the name of a course from its position in the cached course list"""
+        course_list = cls.load_course_list(school_index)
+        cls._require_indexed_item(course_list, course_index, constant.ARG_COURSE)
+        return (normalize_course_url(get_course_url(course_list, course_index)),
+                get_course_code(course_list, course_index), get_course_name(course_list, course_index))
+
+    @classmethod
+    def resolve_timetable(cls, school_index, course_index, year, curr_index):
+        """Maps the positional request arguments of a timetable to a TimetableRef, through the cached catalog"""
+        course_url, course_code, course_name = cls.resolve_course(school_index, course_index)
+        curricula = cls.load_curricula_for(course_url, year)
+        cls._require_indexed_item(curricula, curr_index, constant.ARG_CURR)
+        return TimetableRef(course_url, course_code, year, get_curr_code(curricula, curr_index), course_name)
+
+    @classmethod
+    def resolve_course_code(cls, school_index, course_code):
+        """Gets the normalized URL and the name of a course from its code, through the cached course list"""
+        course_list = cls.load_course_list(school_index)
+        course_index = cls._require_coded_item(course_list, get_course_code, course_code, constant.ARG_COURSE)
+        return (normalize_course_url(get_course_url(course_list, course_index)),
+                get_course_name(course_list, course_index))
+
+    @classmethod
+    def resolve_timetable_codes(cls, school_index, course_code, year, curr_code):
+        """Maps a course code and curriculum code to a TimetableRef, through the cached course list and curricula"""
+        course_url, course_name = cls.resolve_course_code(school_index, course_code)
+        curricula = cls.load_curricula_for(course_url, year)
+        cls._require_coded_item(curricula, get_curr_code, curr_code, constant.ARG_CURR)
+        return TimetableRef(course_url, course_code, year, curr_code, course_name)
+
+    @classmethod
+    def load_curricula(cls, school_index, course_code, year):
+        course_url = cls.resolve_course_code(school_index, course_code)[0]
+        return cls.load_curricula_for(course_url, year)
+
+    @classmethod
+    def load_curricula_for(cls, course_url, year):
+        return cls._cached_call(("curricula", course_url, year), lambda: get_curricula(course_url, year))
+
+    @classmethod
+    def load_timetable_bundle(cls, school_index, course_code, year, curr_code):
+        return cls.load_timetable_bundle_for(cls.resolve_timetable_codes(school_index, course_code, year, curr_code))
+
+    @classmethod
+    def load_timetable_bundle_for(cls, ref):
+        key = ("timetable",) + ref.cache_key()
+
+        def load():
+            bundle = get_timetable_bundle(ref.course_url, ref.year, ref.curr_code)
+            # Unchanged lessons keep their data version, and with it the DTSTAMP of their events.
+            previous = cls._cache.peek(key)
+            bundle[0].keep_version_of(previous[0][0] if previous is not None else None)
+            return bundle
+
+        # Classes and timetable share one cache entry so the usual getclasses -> getical flow
+        # downloads the upstream timetable only once.
+        return cls._cached_call(key, load)
+
+    @classmethod
+    def calendar_etag(cls, ref, timetable, selected_classes):
+        # The file is fully determined by these values, so the ETag is known before anything is rendered.
+        return make_etag(ref.uid_namespace(), timetable.digest(), timetable.version, selected_classes)
+
+    @classmethod
+    def load_selected_classes(cls, ref, classes_mask):
+        timetable, classes = cls.load_timetable_bundle_for(ref)
+        selected_classes = []
+        for i, current_class in enumerate(classes):
+            if (1 << i) & classes_mask:
+                selected_classes.append(current_class)
+        return timetable, selected_classes
+
+    @classmethod
+    def render_calendar(cls, ref, timetable, selected_classes):
+        """Yields the calendar file in pieces, loading each class' cached events only when it is reached"""
+        return iter_ical_file(
+            cls.load_class_events(ref, timetable, current_class) for current_class in selected_classes
+        )
+
+    @classmethod
+    def load_feed(cls, ref, classes_mask):
+        """Gets the pre-rendered (body, etag) tuple of a calendar feed"""
+
+        def load():
+            timetable, selected_classes = cls.load_selected_classes(ref, classes_mask)
+            etag = cls.calendar_etag(ref, timetable, selected_classes)
+            return b"".join(cls.render_calendar(ref, timetable, selected_classes)), etag
+
+        return cls._cached_call(("feed",) + ref.cache_key() + (classes_mask,), load)
+
+    @classmethod
+    def load_class_events(cls, ref, timetable, class_name):
+        # Keyed by the timetable digest and version, so a refreshed timetable never reuses blocks rendered from
+        # older data. The version goes in as a string: cache keys only hold strings and ints.
+        version = timetable.version.isoformat() if timetable.version is not None else ""
+        key = ("events",) + ref.cache_key() + (class_name, timetable.digest(), version)
+        return cls._cached_call(key, lambda: render_class_events(timetable, class_name, ref.uid_namespace()))
+
+    @classmethod
+    def render_metrics(cls):
+        """Renders the registered metrics and the stats of the cache, upstream pools and other components"""
+        cache_stats = cls._cache.stats()
+        persistent_stats = cache_stats.pop("persistent", None)
+        with cls._refresh_lock:
+            refreshing = len(cls._refreshing)
+        families = [
+            ("orariosync_upstream", "Upstream connection, queuing and circuit breaker counters per UniBo host",
+             upstream.stats(), ("host",)),
+            ("orariosync_upstream_store", "Upstream revalidation counters", upstream.response_store.stats(), ()),
+            ("orariosync_cache_family", "Cache counters per key family", cache_stats.pop("families", {}),
+             ("family",)),
+            ("orariosync_cache", "Response cache counters", cache_stats, ()),
+            ("orariosync_cache_refresh", "Background cache refreshes", {"in_flight": refreshing}, ()),
+        ]
+        if persistent_stats is not None:
+            families += [
+                ("orariosync_persistent_cache_family", "Persistent cache counters per key family",
+                 persistent_stats.pop("families", {}), ("family",)),
+                ("orariosync_persistent_cache", "Persistent cache counters", persistent_stats, ()),
+            ]
+        for name, stats in sorted(cls._stats_sources.items()):
+            families.append(("orariosync_" + name, "Counters of the {}".format(name.replace("_", " ")), stats(), ()))
+        return metrics.render(families).encode("utf-8")
 
     def _set_headers(self, status=200, content_type="application/json", cors_origin=None, extra=None):
+        self._response_status = status
         self.send_response(status)
-        self.send_header("Content-type", content_type)
+        if content_type is not None:
+            self.send_header("Content-type", content_type)
         if cors_origin is not None:
             self.send_header("Access-Control-Allow-Origin", cors_origin)
             self.send_header("Vary", "Origin")
@@ -99,9 +437,63 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 self.send_header(key, value)
         self.end_headers()
 
-    def _json_response(self, payload, status=200, cors_origin=None):
-        self._set_headers(status=status, content_type="application/json", cors_origin=cors_origin)
-        self.wfile.write(json.dumps(payload).encode("utf-8"))
+    def _send_cacheable(self, body, etag, content_type, cors_origin=None, extra=None):
+        """Sends a cacheable response, or 304 if the client has it already
+
+        body is either bytes or a callable returning an iterable of byte chunks, which is only called if the body
+        is actually sent, and streamed."""
+        headers = {"ETag": etag, "Cache-Control": RESPONSE_CACHE_CONTROL}
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self._set_headers(status=304, content_type=None, cors_origin=cors_origin, extra=headers)
+            return
+        headers.update(extra or {})
+        if not callable(body):
+            headers["Content-Length"] = str(len(body))
+            self._set_headers(status=200, content_type=content_type, cors_origin=cors_origin, extra=headers)
+            self.wfile.write(body)
+            return
+        if self.request_version == "HTTP/1.0":
+            # No chunked encoding before HTTP/1.1: the end of the body is marked by closing the connection.
+            self.close_connection = True
+        else:
+            headers["Transfer-Encoding"] = "chunked"
+        self._set_headers(status=200, content_type=content_type, cors_origin=cors_origin, extra=headers)
+        self._write_chunks(body(), chunked=not self.close_connection)
+
+    def _write_chunks(self, chunks, chunked=True):
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as exc:  # noqa: BLE001 - the status line is gone, so no error response can follow
+            # Leave the body unterminated so the client sees a failed transfer instead of a short calendar.
+            self.close_connection = True
+            logger.warning("Streaming %s failed: %s", self.path, exc)
+
+    def _cached_json_response(self, key, loader, cors_origin=None):
+        body, etag = self._cached_representation(key, loader)
+        self._send_cacheable(body, etag, "application/json", cors_origin=cors_origin)
+
+    def _json_response(self, payload, status=200, cors_origin=None, extra=None):
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Length": str(len(body))}
+        headers.update(extra or {})
+        self._set_headers(status=status, content_type="application/json", cors_origin=cors_origin, extra=headers)
+        self.wfile.write(body)
+
+    def _is_local_request(self):
+        # A reverse proxy on this host connects from loopback too, but adds X-Forwarded-For to what it proxies.
+        try:
+            loopback = ipaddress.ip_address(self.client_address[0]).is_loopback
+        except (IndexError, TypeError, ValueError):
+            return False
+        return loopback and "X-Forwarded-For" not in self.headers
 
     def _resolve_cors_origin(self):
         return resolve_cors_origin(self.headers.get("Origin"))
@@ -112,6 +504,14 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             raise ClientInputError("Parameter '{}' points outside available data".format(field_name))
         return items[index]
 
+    @staticmethod
+    def _require_coded_item(items, get_code, code, field_name):
+        """Gets the index of the item whose code, as read by get_code(items, index), is code"""
+        for index in range(len(items)):
+            if get_code(items, index) == code:
+                return index
+        raise ClientInputError("Parameter '{}' points outside available data".format(field_name))
+
     def _parse_school(self, params):
         return parse_non_negative_int(params, constant.ARG_SCHOOL, default=0)
 
@@ -129,9 +529,6 @@ class LocalApiHandler(BaseHTTPRequestHandler):
         mask = parse_non_negative_int(params, constant.ARG_CLASSES, default=0)
         return validate_classes_mask(mask)
 
-    def _get_course_list(self, school_index):
-        return self._cached_call(("courses", school_index), lambda: get_course_list(school_index + 1))
-
     def do_OPTIONS(self):
         try:
             cors_origin = self._resolve_cors_origin()
@@ -141,6 +538,18 @@ class LocalApiHandler(BaseHTTPRequestHandler):
         self._set_headers(status=204, cors_origin=cors_origin)
 
     def do_GET(self):
+        route = route_name(urlparse(self.path).path)
+        self._response_status = None
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            self._handle_get()
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+            HTTP_RESPONSES.inc(route, str(self._response_status))
+
+    def _handle_get(self):
         parsed = urlparse(self.path)
         path = parsed.path
         params = parse_qs(parsed.query)
@@ -150,17 +559,28 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             cors_origin = self._resolve_cors_origin()
             client_ip = extract_client_ip(self)
             if not self._rate_limit_allows(client_ip):
+                RATE_LIMIT_REJECTIONS.inc()
                 self._json_response({"error": "Rate limit exceeded", "path": path}, status=429, cors_origin=cors_origin)
                 return
 
+            if path == "/api/metrics" and self._is_local_request():
+                body = self.render_metrics()
+                self._set_headers(status=200, content_type=metrics.CONTENT_TYPE, cors_origin=cors_origin,
+                                  extra={"Content-Length": str(len(body)), "Cache-Control": "no-store"})
+                self.wfile.write(body)
+                return
+
             if path in ("/api/getschools.py", "/api/getschools"):
-                schools = self._cached_call("schools", get_department_names)
-                self._json_response(schools, cors_origin=cors_origin)
+                self._cached_json_response(("schools",), self.load_schools, cors_origin=cors_origin)
                 return
 
             if path in ("/api/getcourses.py", "/api/getcourses"):
                 school_index = self._parse_school(params)
-                self._json_response(self._get_course_list(school_index), cors_origin=cors_origin)
+                self._cached_json_response(
+                    ("courses", school_index),
+                    lambda: self.load_course_list(school_index),
+                    cors_origin=cors_origin,
+                )
                 return
 
             if path in ("/api/getcurricula.py", "/api/getcurricula"):
@@ -168,14 +588,12 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 course_index = self._parse_course(params)
                 year = self._parse_year(params)
 
-                course_list = self._get_course_list(school_index)
-                self._require_indexed_item(course_list, course_index, constant.ARG_COURSE)
-                course_url = get_course_url(course_list, course_index)
-                curricula = self._cached_call(
-                    ("curricula", school_index, course_index, year),
-                    lambda: get_curricula(course_url, year),
+                course_url = self.resolve_course(school_index, course_index)[0]
+                self._cached_json_response(
+                    ("curricula", course_url, year),
+                    lambda: self.load_curricula_for(course_url, year),
+                    cors_origin=cors_origin,
                 )
-                self._json_response(curricula, cors_origin=cors_origin)
                 return
 
             if path in ("/api/getclasses.py", "/api/getclasses"):
@@ -184,20 +602,13 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 year = self._parse_year(params)
                 curr_index = self._parse_curriculum(params)
 
-                course_list = self._get_course_list(school_index)
-                self._require_indexed_item(course_list, course_index, constant.ARG_COURSE)
-                course_url = get_course_url(course_list, course_index)
-                curricula = self._cached_call(
-                    ("curricula", school_index, course_index, year),
-                    lambda: get_curricula(course_url, year),
-                )
-                self._require_indexed_item(curricula, curr_index, constant.ARG_CURR)
-                curr_code = get_curr_code(curricula, curr_index)
-                classes = self._cached_call(
-                    ("classes", school_index, course_index, year, curr_index),
-                    lambda: get_classes(course_url, year, curr_code),
+                ref = self.resolve_timetable(school_index, course_index, year, curr_index)
+                self._cached_json_response(
+                    ("timetable",) + ref.cache_key(),
+                    lambda: self.load_timetable_bundle_for(ref),
+                    cors_origin=cors_origin,
                 )
-                self._json_response(classes, cors_origin=cors_origin)
+                self._remember_timetable_request(school_index, ref)
                 return
 
             if path in ("/api/getical.py", "/api/getical"):
@@ -207,41 +618,34 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 curr_index = self._parse_curriculum(params)
                 selected_classes_btm = self._parse_classes_mask(params)
 
-                course_list = self._get_course_list(school_index)
-                self._require_indexed_item(course_list, course_index, constant.ARG_COURSE)
-                course_url = get_course_url(course_list, course_index)
-                curricula = self._cached_call(
-                    ("curricula", school_index, course_index, year),
-                    lambda: get_curricula(course_url, year),
-                )
-                self._require_indexed_item(curricula, curr_index, constant.ARG_CURR)
-                curr_code = get_curr_code(curricula, curr_index)
+                ref = self.resolve_timetable(school_index, course_index, year, curr_index)
+                timetable, selected_classes = self.load_selected_classes(ref, selected_classes_btm)
+                self._remember_timetable_request(school_index, ref)
+                etag = self.calendar_etag(ref, timetable, selected_classes)
 
-                classes = self._cached_call(
-                    ("classes", school_index, course_index, year, curr_index),
-                    lambda: get_classes(course_url, year, curr_code),
-                )
-                selected_classes = []
-                for i, current_class in enumerate(classes):
-                    if (1 << i) & selected_classes_btm:
-                        selected_classes.append(current_class)
-
-                timetable = self._cached_call(
-                    ("timetable", school_index, course_index, year, curr_index),
-                    lambda: get_timetable(course_url, year, curr_code),
-                )
-                calendar = get_ical_file(timetable, selected_classes)
-
-                course_code = get_course_code(course_list, course_index)
-                course_name = get_safe_course_name(get_course_name(course_list, course_index))
-                filename = "{}_{}_{}.ics".format(course_code, course_name, year)
-                self._set_headers(
-                    status=200,
-                    content_type="application/octet-stream",
+                filename = "{}_{}_{}.ics".format(ref.course_code, get_safe_course_name(ref.course_name), year)
+                self._send_cacheable(
+                    lambda: self.render_calendar(ref, timetable, selected_classes),
+                    etag,
+                    "application/octet-stream",
                     cors_origin=cors_origin,
                     extra={"Content-Disposition": "attachment; filename={}".format(filename)},
                 )
-                self.wfile.write(calendar)
+                return
+
+            feed_match = FEED_PATH.match(path)
+            if feed_match:
+                # Calendar apps poll this URL, so the whole file is cached pre-rendered with its ETag.
+                school, course_code, year, curr_code, classes = feed_match.groups()
+                feed_params = {name: [value] for name, value in zip(FEED_PATH_ARGS, (school, year, classes))}
+                school_index = self._parse_school(feed_params)
+                year = self._parse_year(feed_params)
+                selected_classes_btm = self._parse_classes_mask(feed_params)
+
+                ref = self.resolve_timetable_codes(school_index, course_code, year, curr_code)
+                body, etag = self.load_feed(ref, selected_classes_btm)
+                self._remember_timetable_request(school_index, ref)
+                self._send_cacheable(body, etag, "text/calendar; charset=utf-8", cors_origin=cors_origin)
                 return
 
             self._json_response({"error": "Not found", "path": path}, status=404, cors_origin=cors_origin)
@@ -249,22 +653,275 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             self._json_response({"error": "Origin not allowed", "path": path}, status=403)
         except (ClientInputError, IndexError, KeyError) as exc:
             self._json_response({"error": str(exc), "path": path}, status=400, cors_origin=cors_origin)
+        except UpstreamUnavailableError:
+            # The circuit breaker failed this fast; stale cached data, when there was any, was already served.
+            self._json_response(
+                {"error": "UniBo is currently unavailable, retry later", "path": path},
+                status=503,
+                cors_origin=cors_origin,
+                extra={"Retry-After": str(int(upstream.BREAKER_OPEN_SECONDS))},
+            )
         except UpstreamDataError:
             self._json_response(
                 {"error": "Unable to retrieve timetable data from UniBo", "path": path},
                 status=502,
                 cors_origin=cors_origin,
             )
-        except Exception as exc:  # noqa: BLE001 - explicit debugging aid for local runs
-            print("Internal API error on {}: {}".format(path, exc), file=sys.stderr)
+        except Exception:  # noqa: BLE001 - explicit debugging aid for local runs
+            logger.exception("Internal API error on %s", path)
             self._json_response({"error": "Internal server error", "path": path}, status=500, cors_origin=cors_origin)
 
 
+class CacheWarmerSource:
+    """Exposes LocalApiHandler's cached loaders to the cache warmer
+
+    Stale entries met while warming are refreshed synchronously on the warmer's own rate-limited threads
+    instead of being queued on the background refresh executor. Warming requests queue behind interactive
+    ones for upstream slots."""
+
+    def __init__(self, handler_cls):
+        self.handler_cls = handler_cls
+
+    def _call(self, loader, *args):
+        self.handler_cls._sync_refresh.enabled = True
+        try:
+            with upstream.request_priority(upstream.PRIORITY_BACKGROUND):
+                return loader(*args)
+        finally:
+            self.handler_cls._sync_refresh.enabled = False
+
+    def recent_timetables(self):
+        return self.handler_cls.recent_timetables()
+
+    def load_schools(self):
+        return self._call(self.handler_cls.load_schools)
+
+    def load_course_list(self, school_index):
+        return self._call(self.handler_cls.load_course_list, school_index)
+
+    def load_curricula(self, school_index, course_code, year):
+        return self._call(self.handler_cls.load_curricula, school_index, course_code, year)
+
+    def load_timetable_bundle(self, school_index, course_code, year, curr_code):
+        return self._call(self.handler_cls.load_timetable_bundle, school_index, course_code, year, curr_code)
+
+
+# A warmed task caches its value, the value's JSON representation and the upstream page kept for revalidation.
+CACHE_ENTRIES_PER_WARMER_TASK = 3
+
+
+def create_cache_warmer(priority):
+    """Creates a cache warmer that fills LocalApiHandler's cache
+
+    Without a persistent tier a full pass would evict the entries users asked for, so each pass only starts enough
+    tasks to fill WARMER_MEMORY_FRACTION of the memory cache."""
+    max_tasks = None
+    if not isinstance(LocalApiHandler._cache, TieredCache):
+        max_tasks = int(LocalApiHandler._cache.max_entries * WARMER_MEMORY_FRACTION) // CACHE_ENTRIES_PER_WARMER_TASK
+    return CacheWarmer(CacheWarmerSource(LocalApiHandler), priority=priority, max_tasks=max_tasks)
+
+
+async def _drain(writer):
+    """Waits until the transport has drained, aborting the connection if the client stops reading for too long"""
+    try:
+        await asyncio.wait_for(writer.drain(), KEEPALIVE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        # close() would wait for the unread bytes to be flushed: drop them with the connection.
+        writer.transport.abort()
+        raise ConnectionResetError("Client stopped reading the response")
+
+
+class _StreamWriterFile:
+    """Write-only file object that lets a handler thread write to an asyncio StreamWriter
+
+    Every write waits until the transport has drained, so a slow client slows down its own handler thread
+    instead of piling response bytes up in memory. A client that reads nothing for KEEPALIVE_TIMEOUT_SECONDS
+    is disconnected and the write raises ConnectionResetError, like a socket timeout on the threaded server,
+    so it cannot hold a worker thread forever."""
+
+    closed = False
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await _drain(self.writer)
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionResetError("Connection already aborted")
+        try:
+            asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()
+        except ConnectionError:
+            self.closed = True
+            raise
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class BufferedApiHandler(LocalApiHandler):
+    """Runs LocalApiHandler on a request the asyncio server has already read, writing the response to wfile
+
+    Routing, CORS, rate limiting, caching and streaming are exactly those of the threaded server."""
+
+    def __init__(self, raw_request, client_address, wfile):
+        self._raw_request = raw_request
+        self._wfile = wfile
+        super().__init__(None, client_address, None)
+
+    def setup(self):
+        self.rfile = io.BytesIO(self._raw_request)
+        self.wfile = self._wfile
+
+    def handle(self):
+        # One request per instance: the asyncio server reads the next one and decides whether to keep alive.
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        self.wfile.flush()
+
+
+class AsyncApiServer:
+    """Serves LocalApiHandler from an asyncio event loop instead of one OS thread per connection
+
+    Connections are parsed and kept alive on the event loop; only requests themselves run, on a pool of at most
+    `workers` threads, since the getters block on upstream I/O. At most `max_pending` requests may be running
+    or waiting for a worker: later ones are answered right away with 503 instead of queuing without bound."""
+
+    def __init__(self, handler_cls=BufferedApiHandler, workers=ASYNC_WORKERS, max_pending=ASYNC_MAX_PENDING):
+        self.handler_cls = handler_cls
+        self.max_pending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="api-worker")
+        self._pending = 0
+        self._counters = {"connections": 0, "requests": 0, "rejected": 0}
+
+    def stats(self):
+        """Gets request counters and the number of requests running or waiting for a worker"""
+        counters = dict(self._counters)
+        counters["pending"] = self._pending
+        return counters
+
+    async def _read_request(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT_SECONDS)
+        headers = parse_headers(io.BytesIO(head.split(b"\r\n", 1)[1]))
+        body_length = int(headers.get("Content-Length") or 0)
+        if body_length > ASYNC_MAX_REQUEST_BYTES:
+            raise ValueError("Request body too large")
+        body = await reader.readexactly(body_length) if body_length else b""
+        return head + body, headers
+
+    @staticmethod
+    def _busy_response(head, headers):
+        path = urlparse(head.split(b" ", 2)[1].decode("latin-1") if head.count(b" ") >= 2 else "").path
+        body = json.dumps({"error": "Server busy, retry later", "path": path}).encode("utf-8")
+        lines = [
+            "HTTP/1.1 503 Service Unavailable",
+            "Content-type: application/json",
+            "Content-Length: {}".format(len(body)),
+            "Retry-After: 1",
+            "Connection: close",
+        ]
+        try:
+            cors_origin = resolve_cors_origin(headers.get("Origin"))
+        except OriginNotAllowedError:
+            cors_origin = None
+        if cors_origin is not None:
+            lines += [
+                "Access-Control-Allow-Origin: {}".format(cors_origin),
+                "Vary: Origin",
+                "Access-Control-Allow-Methods: GET, OPTIONS",
+                "Access-Control-Allow-Headers: Content-Type",
+            ]
+        return "\r\n".join(lines).encode("latin-1") + b"\r\n\r\n" + body
+
+    def _handle(self, raw_request, client_address, wfile):
+        handler = self.handler_cls(raw_request, client_address, wfile)
+        return handler.close_connection
+
+    async def _serve_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")
+        wfile = _StreamWriterFile(writer, loop)
+        self._counters["connections"] += 1
+        try:
+            while True:
+                try:
+                    raw_request, headers = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+                    return
+                self._counters["requests"] += 1
+                if self._pending >= self.max_pending:
+                    self._counters["rejected"] += 1
+                    writer.write(self._busy_response(raw_request, headers))
+                    await _drain(writer)
+                    return
+                self._pending += 1
+                try:
+                    close_connection = await loop.run_in_executor(
+                        self._executor, self._handle, raw_request, client_address, wfile)
+                finally:
+                    self._pending -= 1
+                if close_connection:
+                    return
+        except (ConnectionError, OSError):
+            return
+        except Exception:  # noqa: BLE001 - one broken connection must not stop the server
+            logger.exception("Connection from %s failed", client_address)
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._serve_connection, host, port, limit=ASYNC_MAX_REQUEST_BYTES)
+        async with server:
+            await server.serve_forever()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Run local backend API server.")
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--warm", action="store_true", help="pre-scrape the whole catalog in the background")
+    parser.add_argument(
+        "--warm-only",
+        action="store_true",
+        help="run one cache warming pass and exit (useful with BACKEND_CACHE_PATH to prime the persistent cache)",
+    )
+    parser.add_argument("--warm-priority", default=WARMER_PRIORITY, choices=WARMER_PRIORITIES)
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="serve from an asyncio event loop with a bounded worker pool instead of a thread per connection",
+    )
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Parsed upstream pages kept for revalidation count against the same memory budget as the cached responses.
+    upstream.response_store = upstream.ResponseStore(LocalApiHandler._cache)
+    if args.warm_only:
+        warmer = create_cache_warmer(args.warm_priority)
+        warmer.run_pass()
+        print("Cache warming pass finished: {}".format(warmer.stats()))
+        return
+
+    start_sweeper(LocalApiHandler._cache)
+    if args.warm:
+        warmer = create_cache_warmer(args.warm_priority)
+        LocalApiHandler._stats_sources["warmer"] = warmer.stats
+        warmer.start()
+    if args.asyncio:
+        async_server = AsyncApiServer()
+        LocalApiHandler._stats_sources["async_server"] = async_server.stats
+        print("Local API (asyncio) running on http://{}:{}/api".format(args.host, args.port))
+        try:
+            asyncio.run(async_server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        return
 
     server = ThreadingHTTPServer((args.host, args.port), LocalApiHandler)
     print("Local API running on http://{}:{}/api".format(args.host, args.port))